@@ -1,19 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from typing import Dict, Any, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only, raiseload
+from typing import Dict, Any, List, Optional, Tuple
 from pydantic import BaseModel
+from datetime import datetime
 import logging
+import asyncio
+import functools
+import hashlib
 import importlib
 import inspect
+import orjson
+import sys
 
-from app.database import get_db
-from app.auth import check_agent_access
+from app.database import get_async_db, dialect_insert
+from app.auth import check_agent_access, get_subscription_user
+from app.cache import TTLCache
 from app.config import settings
 from app.models import UserAgent, AgentUsage, AgentListing
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/api/agents", tags=["agents"])
+router = APIRouter(prefix="/api/agents", tags=["agents"], default_response_class=ORJSONResponse)
 
 class AgentInfo(BaseModel):
     id: str
@@ -56,9 +66,60 @@ AGENT_DESCRIPTIONS = {
     "portfolioadvisoragent": "Get personalized portfolio advice and recommendations."
 }
 
+# Tier lookups, computed once at import from the static tier config
+AGENT_FIRST_TIER: Dict[str, str] = {}
+for _tier_id, _tier_data in settings.SUBSCRIPTION_TIERS.items():
+    for _agent_id in _tier_data["agents"]:
+        AGENT_FIRST_TIER.setdefault(_agent_id, _tier_id)
+
+# (name, description, first tier) per agent, for building AgentInfo responses
+AGENT_META: Dict[str, Tuple[str, str, str]] = {
+    agent_id: (
+        AGENT_MODULES[agent_id]["name"],
+        AGENT_DESCRIPTIONS.get(agent_id, ""),
+        AGENT_FIRST_TIER.get(agent_id, "enterprise")
+    )
+    for agent_id in AGENT_MODULES
+}
+
+# Struct-of-arrays view of every tiered agent, in order of first tier appearance
+_AGENT_IDS: Tuple[str, ...] = tuple(AGENT_FIRST_TIER)
+_AGENT_NAMES: Tuple[str, ...] = tuple(AGENT_META[a][0] for a in _AGENT_IDS)
+_AGENT_DESCS: Tuple[str, ...] = tuple(AGENT_META[a][1] for a in _AGENT_IDS)
+_AGENT_FIRST_TIERS: Tuple[str, ...] = tuple(AGENT_META[a][2] for a in _AGENT_IDS)
+
 # Agent module cache
 agent_instances = {}
 
+# Rendered /list bodies and ETags per (user_id, tier), dropped by toggle_agent
+_LIST_CACHE = TTLCache(maxsize=10_000, ttl=60)
+
+@functools.lru_cache(maxsize=None)
+def _resolve_agent_class(agent_id: str):
+    """
+    Resolve an agent's class and whether its constructor takes an api_key
+    """
+    agent_info = AGENT_MODULES[agent_id]
+    module = sys.modules.get(agent_info["module"]) or importlib.import_module(agent_info["module"])
+    agent_class = getattr(module, agent_info["class"])
+    
+    # Check if class has an __init__ that takes openrouter_api_key
+    accepts_api_key = "api_key" in inspect.signature(agent_class.__init__).parameters
+    return agent_class, accepts_api_key
+
+async def warm_agent_modules():
+    """
+    Import all agent modules in worker threads so the first request doesn't pay for it
+    """
+    module_names = [info["module"] for info in AGENT_MODULES.values()]
+    results = await asyncio.gather(
+        *(asyncio.to_thread(importlib.import_module, name) for name in module_names),
+        return_exceptions=True
+    )
+    for name, result in zip(module_names, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"Could not pre-load agent module {name}: {result}")
+
 async def get_agent_instance(agent_id: str):
     """
     Get an instance of an agent by ID, with caching
@@ -66,17 +127,12 @@ async def get_agent_instance(agent_id: str):
     if agent_id in agent_instances:
         return agent_instances[agent_id]
     
-    agent_info = AGENT_MODULES.get(agent_id)
-    if not agent_info:
+    if agent_id not in AGENT_MODULES:
         raise ValueError(f"Unknown agent ID: {agent_id}")
     
     try:
-        module = importlib.import_module(agent_info["module"])
-        agent_class = getattr(module, agent_info["class"])
-        
-        # Check if class has an __init__ that takes openrouter_api_key
-        init_params = inspect.signature(agent_class.__init__).parameters
-        if "api_key" in init_params:
+        agent_class, accepts_api_key = _resolve_agent_class(agent_id)
+        if accepts_api_key:
             instance = agent_class(api_key=settings.OPENROUTER_API_KEY)
         else:
             instance = agent_class()
@@ -87,68 +143,89 @@ async def get_agent_instance(agent_id: str):
         logger.error(f"Error loading agent {agent_id}: {str(e)}")
         raise ValueError(f"Failed to load agent {agent_id}: {str(e)}")
 
+# Columns shown in marketplace listings; the long text and JSON columns are left unloaded
+LISTING_SUMMARY_COLUMNS = (
+    AgentListing.id,
+    AgentListing.name,
+    AgentListing.short_description,
+    AgentListing.logo_url,
+    AgentListing.category,
+    AgentListing.base_price,
+    AgentListing.rating_average,
+    AgentListing.rating_count,
+)
+
 @router.get("/")
-def list_agents(db: Session = Depends(get_db)):
-    agents = db.query(AgentListing).all()
-    return agents
+async def list_agents(db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(
+        select(AgentListing).options(load_only(*LISTING_SUMMARY_COLUMNS), raiseload("*"))
+    )
+    return result.scalars().all()
 
 @router.post("/")
-def create_agent(request: AgentCreateRequest, db: Session = Depends(get_db)):
+async def create_agent(request: AgentCreateRequest, db: AsyncSession = Depends(get_async_db)):
     agent = AgentListing(
         name=request.name,
         short_description=request.short_description,
         category=request.category
     )
     db.add(agent)
-    db.commit()
-    db.refresh(agent)
-    return agent
-
-@router.get("/{agent_id}")
-def get_agent(agent_id: int, db: Session = Depends(get_db)):
-    agent = db.query(AgentListing).filter(AgentListing.id == agent_id).first()
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agent not found")
+    await db.commit()
+    await db.refresh(agent)
     return agent
 
 @router.get("/list", response_model=List[AgentInfo])
-async def list_agents(user_data: Dict[str, Any] = Depends(check_agent_access), db: Session = Depends(get_db)):
+async def list_available_agents(
+    request: Request,
+    user_data: Dict[str, Any] = Depends(get_subscription_user)
+):
     """
     List all available agents
     """
     user_id = user_data["user"].id
     tier = user_data["tier"]
+    cache_key = (user_id, tier)
     
-    # Get user's enabled agents
-    user_agents = {ua.agent_id: ua.is_enabled for ua in db.query(UserAgent).filter(UserAgent.user_id == user_id).all()}
-    
-    # Get available agents for user's tier
-    available_agents = []
-    for tier_id, tier_data in settings.SUBSCRIPTION_TIERS.items():
-        for agent_id in tier_data["agents"]:
-            if agent_id not in [a.id for a in available_agents]:
-                # Determine which tier this agent first appears in
-                for t_id, t_data in settings.SUBSCRIPTION_TIERS.items():
-                    if agent_id in t_data["agents"]:
-                        subscription_tier = t_id
-                        break
-                
-                available_agents.append(AgentInfo(
-                    id=agent_id,
-                    name=AGENT_MODULES.get(agent_id, {}).get("name", agent_id),
-                    description=AGENT_DESCRIPTIONS.get(agent_id, ""),
-                    subscription_tier=subscription_tier,
-                    enabled=user_agents.get(agent_id, agent_id in settings.SUBSCRIPTION_TIERS[tier]["agents"])
-                ))
+    cached = _LIST_CACHE.get(cache_key)
+    if cached is None:
+        # User's agent settings, preloaded with the user by the auth dependency
+        user_agents = {ua.agent_id: ua.is_enabled for ua in user_data["user"].user_agents}
+        
+        # Get available agents for user's tier
+        tier_agents = settings.SUBSCRIPTION_TIER_AGENT_SETS[tier]
+        available_agents = [
+            AgentInfo(
+                id=agent_id,
+                name=name,
+                description=description,
+                subscription_tier=subscription_tier,
+                enabled=user_agents.get(agent_id, agent_id in tier_agents)
+            ).dict()
+            for agent_id, name, description, subscription_tier
+            in zip(_AGENT_IDS, _AGENT_NAMES, _AGENT_DESCS, _AGENT_FIRST_TIERS)
+        ]
+        body = orjson.dumps(available_agents)
+        cached = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+        _LIST_CACHE.set(cache_key, cached)
     
-    return available_agents
+    body, etag = cached
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@router.get("/{agent_id}")
+async def get_agent(agent_id: int, db: AsyncSession = Depends(get_async_db)):
+    agent = await db.get(AgentListing, agent_id)
+    if not agent:
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return agent
 
 @router.post("/{agent_id}/toggle", response_model=AgentInfo)
 async def toggle_agent(
     agent_id: str,
     enabled: bool,
     user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Enable or disable an agent for a user
@@ -157,42 +234,31 @@ async def toggle_agent(
     tier = user_data["tier"]
     
     # Check if agent is available in user's tier
-    available_agents = settings.SUBSCRIPTION_TIERS.get(tier, {}).get("agents", [])
-    if agent_id not in available_agents:
+    if agent_id not in settings.SUBSCRIPTION_TIER_AGENT_SETS.get(tier, frozenset()):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"Your subscription tier does not include access to this agent"
         )
     
-    # Get or create user agent
-    user_agent = db.query(UserAgent).filter(
-        UserAgent.user_id == user_id,
-        UserAgent.agent_id == agent_id
-    ).first()
-    
-    if not user_agent:
-        user_agent = UserAgent(
-            user_id=user_id,
-            agent_id=agent_id,
-            is_enabled=enabled
-        )
-        db.add(user_agent)
-    else:
-        user_agent.is_enabled = enabled
-    
-    db.commit()
-    
-    # Determine which tier this agent first appears in
-    subscription_tier = "enterprise"
-    for t_id, t_data in settings.SUBSCRIPTION_TIERS.items():
-        if agent_id in t_data["agents"]:
-            subscription_tier = t_id
-            break
+    # Create or update the user agent in a single statement
+    stmt = dialect_insert(db, UserAgent).values(
+        user_id=user_id,
+        agent_id=agent_id,
+        is_enabled=enabled
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserAgent.user_id, UserAgent.agent_id],
+        set_={"is_enabled": stmt.excluded.is_enabled}
+    )
+    await db.execute(stmt)
+    await db.commit()
+    _LIST_CACHE.pop((user_id, tier))
     
+    name, description, subscription_tier = AGENT_META[agent_id]
     return AgentInfo(
         id=agent_id,
-        name=AGENT_MODULES.get(agent_id, {}).get("name", agent_id),
-        description=AGENT_DESCRIPTIONS.get(agent_id, ""),
+        name=name,
+        description=description,
         subscription_tier=subscription_tier,
         enabled=enabled
     )
@@ -201,7 +267,7 @@ async def toggle_agent(
 async def get_agent_usage(
     agent_id: str,
     user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get usage statistics for an agent
@@ -209,66 +275,105 @@ async def get_agent_usage(
     user_id = user_data["user"].id
     user_agent = user_data["user_agent"]
     
-    # Get usage records for this agent
-    usage_records = db.query(AgentUsage).filter(
+    # Totals are aggregated in SQL, monthly rows come back as plain tuples
+    totals = await db.execute(select(
+        func.coalesce(func.sum(AgentUsage.request_count), 0),
+        func.coalesce(func.sum(AgentUsage.token_count), 0)
+    ).where(AgentUsage.user_agent_id == user_agent.id))
+    total_requests, total_tokens = totals.one()
+    
+    usage_rows = (await db.execute(select(
+        AgentUsage.month,
+        AgentUsage.year,
+        AgentUsage.request_count,
+        AgentUsage.token_count
+    ).where(
         AgentUsage.user_agent_id == user_agent.id
-    ).order_by(AgentUsage.year.desc(), AgentUsage.month.desc()).all()
+    ).order_by(AgentUsage.year.desc(), AgentUsage.month.desc()))).all()
     
     return {
         "agent_id": agent_id,
-        "total_requests": sum(u.request_count for u in usage_records),
-        "total_tokens": sum(u.token_count for u in usage_records),
+        "total_requests": total_requests,
+        "total_tokens": total_tokens,
         "monthly_usage": [
             {
-                "month": u.month,
-                "year": u.year,
-                "requests": u.request_count,
-                "tokens": u.token_count
-            } for u in usage_records
+                "month": month,
+                "year": year,
+                "requests": requests,
+                "tokens": tokens
+            } for month, year, requests, tokens in usage_rows
         ]
     }
 
 # Function to track agent usage
 async def track_agent_usage(
     user_agent_id: int,
-    subscription_id: int,
+    subscription_id: Optional[int],
     request_count: int = 1,
     token_count: int = 0,
-    db: Session = None
+    db: AsyncSession = None,
+    result: Any = None
 ):
     """
-    Track usage of an agent
+    Track usage of an agent, estimating tokens from the agent's result when given
     """
     if not db:
         return
     
+    if result is not None:
+        # Rough estimate of token count, done here to keep it off the response path
+        token_count += len(orjson.dumps(result, default=str, option=orjson.OPT_NON_STR_KEYS)) // 4
+    
     # Get current month and year
     now = datetime.now()
-    month = now.month
-    year = now.year
     
-    # Get or create usage record
-    usage = db.query(AgentUsage).filter(
-        AgentUsage.user_agent_id == user_agent_id,
-        AgentUsage.subscription_id == subscription_id,
-        AgentUsage.month == month,
-        AgentUsage.year == year
-    ).first()
-    
-    if not usage:
-        usage = AgentUsage(
-            user_agent_id=user_agent_id,
-            subscription_id=subscription_id,
-            month=month,
-            year=year,
-            request_count=0,
-            token_count=0
+    if subscription_id is None:
+        # NULLs never conflict in the unique index, so usage without a subscription
+        # is matched with IS NULL and only inserted when no row exists yet
+        update_result = await db.execute(
+            update(AgentUsage)
+            .where(
+                AgentUsage.user_agent_id == user_agent_id,
+                AgentUsage.subscription_id.is_(None),
+                AgentUsage.year == now.year,
+                AgentUsage.month == now.month
+            )
+            .values(
+                request_count=AgentUsage.request_count + request_count,
+                token_count=AgentUsage.token_count + token_count,
+                last_used=datetime.utcnow()
+            )
         )
-        db.add(usage)
-    
-    # Update usage counts
-    usage.request_count += request_count
-    usage.token_count += token_count
-    usage.last_used = datetime.utcnow()
+        if not update_result.rowcount:
+            db.add(AgentUsage(
+                user_agent_id=user_agent_id,
+                subscription_id=None,
+                month=now.month,
+                year=now.year,
+                request_count=request_count,
+                token_count=token_count,
+                last_used=datetime.utcnow()
+            ))
+        await db.commit()
+        return
     
-    db.commit() 
\ No newline at end of file
+    # Create or increment this month's usage row in a single statement
+    stmt = dialect_insert(db, AgentUsage).values(
+        user_agent_id=user_agent_id,
+        subscription_id=subscription_id,
+        month=now.month,
+        year=now.year,
+        request_count=request_count,
+        token_count=token_count,
+        last_used=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AgentUsage.user_agent_id, AgentUsage.subscription_id, AgentUsage.year, AgentUsage.month],
+        set_={
+            "request_count": AgentUsage.request_count + stmt.excluded.request_count,
+            "token_count": AgentUsage.token_count + stmt.excluded.token_count,
+            "last_used": stmt.excluded.last_used
+        }
+    )
+    await db.execute(stmt)
+    await db.commit() 
\ No newline at end of file
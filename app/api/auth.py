@@ -1,14 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, BackgroundTasks
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from datetime import timedelta, datetime
 from typing import Dict, Any, Optional
 from pydantic import BaseModel, EmailStr, Field
+import asyncio
 import logging
 import json
 from passlib.context import CryptContext
 
-from app.database import get_db
+from app.auth import DUMMY_PASSWORD_HASH
+from app.database import get_async_db
 from app.models import User, Subscription
 from app.config import settings
 
@@ -16,40 +21,54 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=settings.BCRYPT_ROUNDS, deprecated="auto")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt is deliberately slow, so run it off the event loop
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+async def get_password_hash(password: str) -> str:
+    return await asyncio.to_thread(pwd_context.hash, password)
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = db.query(User).filter(User.email == email).first()
-    if not user:
+# Loads a user's active subscriptions in the same query as the user row
+_active_subscriptions = joinedload(User.subscriptions.and_(Subscription.is_active == True))
+
+def _latest_subscription(user: User) -> Optional[Subscription]:
+    return max(user.subscriptions, key=lambda s: s.id, default=None)
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    result = await db.execute(
+        select(User).where(User.email == email).options(_active_subscriptions)
+    )
+    user = result.unique().scalars().first()
+    if not user or not user.hashed_password:
+        # Spend the same bcrypt time as a real check so unknown emails aren't distinguishable
+        await verify_password(password, DUMMY_PASSWORD_HASH)
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = "demo-token"  # TODO: Implement proper JWT
-    return encoded_jwt
+def create_access_token(sub: str, expires_delta: Optional[timedelta] = None):
+    # TODO: Implement proper JWT for sub, expiring after expires_delta (default 15 minutes)
+    return "demo-token"
+
+# Id of the demo user, resolved on first use
+_demo_user_id: Optional[int] = None
 
 async def get_current_user(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> User:
     # TODO: Implement proper JWT token validation
     # For now, just get the first user as a demo
-    user = db.query(User).first()
+    global _demo_user_id
+    if _demo_user_id is None:
+        result = await db.execute(select(User.id).order_by(User.id).limit(1))
+        _demo_user_id = result.scalar()
+    user = await db.get(User, _demo_user_id, options=[_active_subscriptions]) if _demo_user_id is not None else None
     if not user:
+        _demo_user_id = None
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not authenticated",
@@ -65,17 +84,12 @@ async def get_current_active_user(
     return current_user
 
 async def get_subscription_user(
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_active_user)
 ) -> Dict[str, Any]:
-    subscription = db.query(Subscription).filter(
-        Subscription.user_id == current_user.id,
-        Subscription.is_active == True
-    ).order_by(Subscription.id.desc()).first()
-    
+    # Active subscriptions were eager-loaded with the user
     return {
         "user": current_user,
-        "subscription": subscription
+        "subscription": _latest_subscription(current_user)
     }
 
 class Token(BaseModel):
@@ -117,9 +131,9 @@ class SignupRequest(BaseModel):
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -128,20 +142,17 @@ async def login_for_access_token(
         )
     
     # Update last login
-    user.last_login = datetime.utcnow()
-    db.commit()
+    await db.execute(
+        update(User).where(User.id == user.id).values(last_login=datetime.utcnow())
+    )
+    await db.commit()
     
     # Create token
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = create_access_token(user.email, expires_delta=access_token_expires)
     
-    # Get subscription info
-    subscription = db.query(Subscription).filter(
-        Subscription.user_id == user.id,
-        Subscription.is_active == True
-    ).order_by(Subscription.id.desc()).first()
+    # Active subscriptions were eager-loaded with the user
+    subscription = _latest_subscription(user)
     
     return {
         "access_token": access_token,
@@ -162,11 +173,11 @@ async def login_for_access_token(
     }
 
 @router.post("/signup")
-def signup(request: SignupRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == request.email).first()
-    if user:
+async def signup(request: SignupRequest, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(exists().where(User.email == request.email)))
+    if result.scalar():
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = get_password_hash(request.password)
+    hashed_password = await get_password_hash(request.password)
     new_user = User(
         email=request.email,
         hashed_password=hashed_password,
@@ -174,8 +185,12 @@ def signup(request: SignupRequest, db: Session = Depends(get_db)):
         last_name=request.last_name
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent signup for the same email
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
     return {"message": "User created successfully"}
 
 @router.get("/me", response_model=UserResponse)
@@ -200,10 +215,11 @@ async def read_users_me(user_data: Dict[str, Any] = Depends(get_subscription_use
 async def request_password_reset(
     reset_data: PasswordReset, 
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Find user by email
-    user = db.query(User).filter(User.email == reset_data.email).first()
+    result = await db.execute(select(User).where(User.email == reset_data.email))
+    user = result.scalars().first()
     if not user:
         # Return success even if user doesn't exist to prevent email enumeration
         return {"message": "If your email is registered, you will receive a password reset link"}
@@ -218,17 +234,17 @@ async def request_password_reset(
 async def change_password(
     password_data: PasswordChange,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Verify current password
-    if not verify_password(password_data.current_password, current_user.hashed_password):
+    if not await verify_password(password_data.current_password, current_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Current password is incorrect"
         )
     
     # Update password
-    current_user.hashed_password = get_password_hash(password_data.new_password)
-    db.commit()
+    current_user.hashed_password = await get_password_hash(password_data.new_password)
+    await db.commit()
     
     return {"message": "Password updated successfully"} 
\ No newline at end of file
@@ -1,18 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
-from sqlalchemy.orm import Session
-from typing import Dict, Any, List, Optional
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Type
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.utils import GetterDict
 import logging
+import orjson
 from datetime import datetime
 
-from app.database import get_db
-from app.auth import check_agent_access
-from app.models import PortfolioRecord, AnalysisResult
+from app.database import get_async_db, AsyncSessionLocal
+from app.auth import require_agent_access
+from app.models import PortfolioRecord, AnalysisResult, Task
 from app.api.agents import get_agent_instance, track_agent_usage
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
+
+check_portfolio_access = require_agent_access("portfolio_agent")
 
 # Re-export models from portfolio_agent
 from portfolio_agent import Position, PortfolioAnalysisRequest, PortfolioOptimizeRequest, RiskAnalysisRequest
@@ -23,31 +31,128 @@ class PortfolioCreate(BaseModel):
     positions: List[Dict[str, Any]]
     is_public: bool = False
 
+class _PortfolioRecordGetter(GetterDict):
+    # Positions are stored inside PortfolioRecord.data rather than as a column
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "positions":
+            return self._obj.data["positions"]
+        return super().get(key, default)
+
 class PortfolioResponse(BaseModel):
     id: int
     name: str
     description: Optional[str] = None
     positions: List[Dict[str, Any]]
-    created_at: str
-    updated_at: str
+    created_at: datetime
+    updated_at: datetime
     is_public: bool
 
+    class Config:
+        orm_mode = True
+        getter_dict = _PortfolioRecordGetter
+
 class AnalysisResponse(BaseModel):
     id: Optional[int] = None
     user_id: int
     agent_id: str
-    created_at: str
+    created_at: datetime
     result_type: str
     input_data: Optional[Dict[str, Any]] = None
     result_data: Dict[str, Any]
     is_saved: bool = False
     name: Optional[str] = None
 
-@router.post("/", response_model=PortfolioResponse)
+    class Config:
+        orm_mode = True
+
+class AnalysisPage(BaseModel):
+    items: List[AnalysisResponse]
+    next_cursor: Optional[datetime] = None
+    next_cursor_id: Optional[int] = None
+
+class AnalysisJob(BaseModel):
+    job_id: int
+    status: str
+
+# Documents the 202 body the analysis endpoints return with run_async
+_ANALYSIS_JOB_RESPONSES = {status.HTTP_202_ACCEPTED: {"model": AnalysisJob}}
+
+# The write endpoints leave out input_data by default, since the caller just sent it
+_ANALYSIS_FIELDS = tuple(AnalysisResponse.__fields__)
+_ANALYSIS_WRITE_FIELDS = tuple(name for name in _ANALYSIS_FIELDS if name != "input_data")
+
+def _analysis_fields_response(analysis: AnalysisResult, fields: Optional[str]) -> ORJSONResponse:
+    """
+    Serialize the requested comma-separated AnalysisResponse fields of a stored analysis
+    """
+    if fields:
+        requested = {name.strip() for name in fields.split(",")}
+        names = [name for name in _ANALYSIS_FIELDS if name in requested]
+    else:
+        names = _ANALYSIS_WRITE_FIELDS
+    return ORJSONResponse(content={name: getattr(analysis, name) for name in names})
+
+def _orjson_body(model: Type[BaseModel]) -> Callable[[Request], Awaitable[BaseModel]]:
+    """
+    Build a dependency that decodes a large JSON body with orjson and validates it as model
+    """
+    async def parse(request: Request) -> BaseModel:
+        try:
+            data = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="There was an error parsing the body")
+        try:
+            return model.parse_obj(data)
+        except ValidationError as e:
+            raise RequestValidationError([ErrorWrapper(e, loc=("body",))], body=data)
+    return parse
+
+def _json_body_openapi(model: Type[BaseModel]) -> Dict[str, Any]:
+    # Documents the body that _orjson_body parses; nested models resolve to the app's components
+    schema = model.schema(ref_template="#/components/schemas/{model}")
+    schema.pop("definitions", None)
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": schema}}}}
+
+def _to_positions(items) -> List[Position]:
+    """
+    Convert request positions to the agent's Position model
+    """
+    return [
+        Position(
+            symbol=pos.symbol,
+            quantity=pos.quantity,
+            cost_basis=pos.cost_basis,
+            purchase_date=pos.purchase_date
+        ) for pos in items
+    ]
+
+async def _persist_analysis(
+    db: AsyncSession,
+    user_id: int,
+    result_type: str,
+    input_data: Dict[str, Any],
+    result_data: Dict[str, Any]
+) -> AnalysisResult:
+    """
+    Store a portfolio agent result and return the row
+    """
+    analysis = AnalysisResult(
+        user_id=user_id,
+        agent_id="portfolio_agent",
+        result_type=result_type,
+        input_data=input_data,
+        result_data=result_data,
+        is_saved=False
+    )
+    db.add(analysis)
+    await db.commit()
+    return analysis
+
+@router.post("/", response_model=PortfolioResponse, openapi_extra=_json_body_openapi(PortfolioCreate))
 async def create_portfolio(
-    portfolio_data: PortfolioCreate,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    portfolio_data: PortfolioCreate = Depends(_orjson_body(PortfolioCreate)),
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Create a new portfolio
@@ -63,60 +168,107 @@ async def create_portfolio(
         is_public=portfolio_data.is_public
     )
     db.add(portfolio)
-    db.commit()
-    db.refresh(portfolio)
+    await db.commit()
     
-    return {
-        "id": portfolio.id,
-        "name": portfolio.name,
-        "description": portfolio.description,
-        "positions": portfolio.data["positions"],
-        "created_at": portfolio.created_at.isoformat(),
-        "updated_at": portfolio.updated_at.isoformat(),
-        "is_public": portfolio.is_public
-    }
+    return PortfolioResponse.from_orm(portfolio)
 
 @router.get("/", response_model=List[PortfolioResponse])
 async def list_portfolios(
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     List all portfolios for the current user
     """
     user_id = user_data["user"].id
     
-    portfolios = db.query(PortfolioRecord).filter(
+    result = await db.execute(select(PortfolioRecord).where(
         PortfolioRecord.user_id == user_id
-    ).order_by(PortfolioRecord.updated_at.desc()).all()
+    ).order_by(PortfolioRecord.updated_at.desc()))
+    portfolios = result.scalars().all()
     
-    return [
+    # Rows are already shaped like PortfolioResponse, so skip per-request response validation
+    return ORJSONResponse(content=[
         {
             "id": portfolio.id,
             "name": portfolio.name,
             "description": portfolio.description,
             "positions": portfolio.data["positions"],
-            "created_at": portfolio.created_at.isoformat(),
-            "updated_at": portfolio.updated_at.isoformat(),
+            "created_at": portfolio.created_at,
+            "updated_at": portfolio.updated_at,
             "is_public": portfolio.is_public
         } for portfolio in portfolios
-    ]
+    ])
+
+# Registered before /{portfolio_id}, which would otherwise capture it
+@router.get("/analysis", response_model=AnalysisPage)
+async def list_analyses(
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db),
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[datetime] = None,
+    cursor_id: Optional[int] = None,
+    agent_id: Optional[str] = None,
+    result_type: Optional[str] = None
+):
+    """
+    List analysis results for the current user, paging on the previous page's next_cursor and next_cursor_id
+    """
+    user_id = user_data["user"].id
+    
+    query = select(AnalysisResult).where(AnalysisResult.user_id == user_id)
+    
+    if agent_id:
+        query = query.where(AnalysisResult.agent_id == agent_id)
+    
+    if result_type:
+        query = query.where(AnalysisResult.result_type == result_type)
+    
+    # Page on (created_at, id), so rows sharing the boundary timestamp aren't skipped
+    if cursor and cursor_id is not None:
+        query = query.where(tuple_(AnalysisResult.created_at, AnalysisResult.id) < tuple_(cursor, cursor_id))
+    elif cursor:
+        query = query.where(AnalysisResult.created_at < cursor)
+    
+    result = await db.execute(
+        query.order_by(AnalysisResult.created_at.desc(), AnalysisResult.id.desc()).limit(limit)
+    )
+    analyses = result.scalars().all()
+    
+    # Rows are already shaped like AnalysisResponse, so skip per-request response validation
+    return ORJSONResponse(content={"items": [
+        {
+            "id": analysis.id,
+            "user_id": analysis.user_id,
+            "agent_id": analysis.agent_id,
+            "created_at": analysis.created_at,
+            "result_type": analysis.result_type,
+            "input_data": analysis.input_data,
+            "result_data": analysis.result_data,
+            "is_saved": analysis.is_saved,
+            "name": analysis.name
+        } for analysis in analyses
+    ], **(
+        {"next_cursor": analyses[-1].created_at, "next_cursor_id": analyses[-1].id}
+        if analyses and len(analyses) == limit else {"next_cursor": None, "next_cursor_id": None}
+    )})
 
 @router.get("/{portfolio_id}", response_model=PortfolioResponse)
 async def get_portfolio(
     portfolio_id: int,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get a portfolio by ID
     """
     user_id = user_data["user"].id
     
-    portfolio = db.query(PortfolioRecord).filter(
+    result = await db.execute(select(PortfolioRecord).where(
         PortfolioRecord.id == portfolio_id,
         PortfolioRecord.user_id == user_id
-    ).first()
+    ))
+    portfolio = result.scalars().first()
     
     if not portfolio:
         raise HTTPException(
@@ -124,32 +276,25 @@ async def get_portfolio(
             detail="Portfolio not found"
         )
     
-    return {
-        "id": portfolio.id,
-        "name": portfolio.name,
-        "description": portfolio.description,
-        "positions": portfolio.data["positions"],
-        "created_at": portfolio.created_at.isoformat(),
-        "updated_at": portfolio.updated_at.isoformat(),
-        "is_public": portfolio.is_public
-    }
+    return PortfolioResponse.from_orm(portfolio)
 
-@router.put("/{portfolio_id}", response_model=PortfolioResponse)
+@router.put("/{portfolio_id}", response_model=PortfolioResponse, openapi_extra=_json_body_openapi(PortfolioCreate))
 async def update_portfolio(
     portfolio_id: int,
-    portfolio_data: PortfolioCreate,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    portfolio_data: PortfolioCreate = Depends(_orjson_body(PortfolioCreate)),
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Update a portfolio
     """
     user_id = user_data["user"].id
     
-    portfolio = db.query(PortfolioRecord).filter(
+    result = await db.execute(select(PortfolioRecord).where(
         PortfolioRecord.id == portfolio_id,
         PortfolioRecord.user_id == user_id
-    ).first()
+    ))
+    portfolio = result.scalars().first()
     
     if not portfolio:
         raise HTTPException(
@@ -162,58 +307,152 @@ async def update_portfolio(
     portfolio.description = portfolio_data.description
     portfolio.data = {"positions": portfolio_data.positions}
     portfolio.is_public = portfolio_data.is_public
-    portfolio.updated_at = datetime.utcnow()
     
-    db.commit()
-    db.refresh(portfolio)
+    # updated_at is stamped by the database and fetched back in the flush (eager_defaults)
+    await db.commit()
     
-    return {
-        "id": portfolio.id,
-        "name": portfolio.name,
-        "description": portfolio.description,
-        "positions": portfolio.data["positions"],
-        "created_at": portfolio.created_at.isoformat(),
-        "updated_at": portfolio.updated_at.isoformat(),
-        "is_public": portfolio.is_public
-    }
+    return PortfolioResponse.from_orm(portfolio)
 
 @router.delete("/{portfolio_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_portfolio(
     portfolio_id: int,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Delete a portfolio
     """
     user_id = user_data["user"].id
     
-    portfolio = db.query(PortfolioRecord).filter(
+    # Portfolio records have no dependent rows, so one DELETE both checks ownership and removes it
+    result = await db.execute(delete(PortfolioRecord).where(
         PortfolioRecord.id == portfolio_id,
         PortfolioRecord.user_id == user_id
-    ).first()
+    ))
     
-    if not portfolio:
+    if not result.rowcount:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Portfolio not found"
         )
     
-    db.delete(portfolio)
-    db.commit()
+    await db.commit()
     
     return None
 
-@router.post("/analyze", response_model=AnalysisResponse)
+async def _run_portfolio_analysis(agent, analysis_request: PortfolioAnalysisRequest) -> Dict[str, Any]:
+    result = await agent.analyze_portfolio(
+        positions=_to_positions(analysis_request.positions),
+        benchmark=analysis_request.benchmark,
+        risk_tolerance=analysis_request.risk_tolerance
+    )
+    
+    # Generate insights
+    result["insights"] = await agent.generate_insights(result)
+    return result
+
+async def _run_portfolio_optimization(agent, optimize_request: PortfolioOptimizeRequest) -> Dict[str, Any]:
+    return await agent.optimize_portfolio(
+        positions=_to_positions(optimize_request.positions),
+        risk_tolerance=optimize_request.risk_tolerance,
+        investment_horizon=optimize_request.investment_horizon,
+        additional_capital=optimize_request.additional_capital,
+        constraints=optimize_request.constraints
+    )
+
+async def _run_risk_analysis(agent, risk_request: RiskAnalysisRequest) -> Dict[str, Any]:
+    return await agent.analyze_risk(
+        positions=_to_positions(risk_request.positions),
+        var_confidence=risk_request.var_confidence,
+        stress_test=risk_request.stress_test
+    )
+
+async def _run_analysis_job(
+    task_id: int,
+    user_id: int,
+    user_agent_id: int,
+    subscription_id: Optional[int],
+    result_type: str,
+    request: BaseModel,
+    run: Callable[[Any, BaseModel], Awaitable[Dict[str, Any]]]
+):
+    """
+    Run a queued analysis after the response is sent, recording progress on its Task row
+    """
+    async with AsyncSessionLocal() as db:
+        task = await db.get(Task, task_id)
+        task.status = "running"
+        task.started_at = datetime.utcnow()
+        await db.commit()
+        
+        result = None
+        try:
+            agent = await get_agent_instance("portfolio_agent")
+            result = await run(agent, request)
+            analysis = await _persist_analysis(db, user_id, result_type, request.dict(), result)
+            task.status = "completed"
+            task.result = {"analysis_id": analysis.id}
+        except Exception as e:
+            logger.error(f"Error running {result_type} job {task_id}: {str(e)}")
+            # A failed flush or commit leaves the session needing a rollback, which expires the task
+            await db.rollback()
+            task = await db.get(Task, task_id)
+            task.status = "failed"
+            task.error = str(e)
+        task.completed_at = datetime.utcnow()
+        await db.commit()
+        
+        if result is not None:
+            await track_agent_usage(user_agent_id, subscription_id, request_count=1, db=db, result=result)
+
+async def _enqueue_analysis_job(
+    db: AsyncSession,
+    background_tasks: BackgroundTasks,
+    user_data: Dict[str, Any],
+    result_type: str,
+    request: BaseModel,
+    run: Callable[[Any, BaseModel], Awaitable[Dict[str, Any]]]
+) -> ORJSONResponse:
+    """
+    Record a pending Task and run the analysis in the background, returning the job id
+    """
+    subscription = user_data["subscription"]
+    task = Task(user_id=user_data["user"].id, task_type=result_type, status="pending")
+    db.add(task)
+    await db.commit()
+    
+    background_tasks.add_task(
+        _run_analysis_job,
+        task.id,
+        task.user_id,
+        user_data["user_agent"].id,
+        subscription.id if subscription else None,
+        result_type,
+        request,
+        run
+    )
+    return ORJSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"job_id": task.id, "status": task.status}
+    )
+
+@router.post("/analyze", response_model=AnalysisResponse, responses=_ANALYSIS_JOB_RESPONSES, openapi_extra=_json_body_openapi(PortfolioAnalysisRequest))
 async def analyze_portfolio(
-    analysis_request: PortfolioAnalysisRequest,
     background_tasks: BackgroundTasks,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    analysis_request: PortfolioAnalysisRequest = Depends(_orjson_body(PortfolioAnalysisRequest)),
+    run_async: bool = False,
+    fields: Optional[str] = None,
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Analyze a portfolio
     """
+    if run_async:
+        return await _enqueue_analysis_job(
+            db, background_tasks, user_data, "portfolio_analysis", analysis_request, _run_portfolio_analysis
+        )
+    
     user_id = user_data["user"].id
     user_agent = user_data["user_agent"]
     subscription = user_data["subscription"]
@@ -221,40 +460,10 @@ async def analyze_portfolio(
     try:
         # Get portfolio agent instance
         agent = await get_agent_instance("portfolio_agent")
-        
-        # Convert positions to the expected format
-        positions = []
-        for pos in analysis_request.positions:
-            positions.append(Position(
-                symbol=pos.symbol,
-                quantity=pos.quantity,
-                cost_basis=pos.cost_basis,
-                purchase_date=pos.purchase_date
-            ))
-        
-        # Call the agent
-        result = await agent.analyze_portfolio(
-            positions=positions,
-            benchmark=analysis_request.benchmark,
-            risk_tolerance=analysis_request.risk_tolerance
-        )
-        
-        # Generate insights
-        insights = await agent.generate_insights(result)
-        result["insights"] = insights
+        result = await _run_portfolio_analysis(agent, analysis_request)
         
         # Store analysis result
-        analysis = AnalysisResult(
-            user_id=user_id,
-            agent_id="portfolio_agent",
-            result_type="portfolio_analysis",
-            input_data=analysis_request.dict(),
-            result_data=result,
-            is_saved=False
-        )
-        db.add(analysis)
-        db.commit()
-        db.refresh(analysis)
+        analysis = await _persist_analysis(db, user_id, "portfolio_analysis", analysis_request.dict(), result)
         
         # Track usage
         background_tasks.add_task(
@@ -262,21 +471,11 @@ async def analyze_portfolio(
             user_agent_id=user_agent.id,
             subscription_id=subscription.id if subscription else None,
             request_count=1,
-            token_count=len(str(result)) // 4,  # Rough estimate of token count
-            db=db
+            db=db,
+            result=result
         )
         
-        return {
-            "id": analysis.id,
-            "user_id": analysis.user_id,
-            "agent_id": analysis.agent_id,
-            "created_at": analysis.created_at.isoformat(),
-            "result_type": analysis.result_type,
-            "input_data": analysis.input_data,
-            "result_data": analysis.result_data,
-            "is_saved": analysis.is_saved,
-            "name": analysis.name
-        }
+        return _analysis_fields_response(analysis, fields)
     except Exception as e:
         logger.error(f"Error analyzing portfolio: {str(e)}")
         raise HTTPException(
@@ -284,16 +483,23 @@ async def analyze_portfolio(
             detail=f"Failed to analyze portfolio: {str(e)}"
         )
 
-@router.post("/optimize", response_model=AnalysisResponse)
+@router.post("/optimize", response_model=AnalysisResponse, responses=_ANALYSIS_JOB_RESPONSES)
 async def optimize_portfolio(
     optimize_request: PortfolioOptimizeRequest,
     background_tasks: BackgroundTasks,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    run_async: bool = False,
+    fields: Optional[str] = None,
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Optimize a portfolio
     """
+    if run_async:
+        return await _enqueue_analysis_job(
+            db, background_tasks, user_data, "portfolio_optimization", optimize_request, _run_portfolio_optimization
+        )
+    
     user_id = user_data["user"].id
     user_agent = user_data["user_agent"]
     subscription = user_data["subscription"]
@@ -301,38 +507,10 @@ async def optimize_portfolio(
     try:
         # Get portfolio agent instance
         agent = await get_agent_instance("portfolio_agent")
-        
-        # Convert positions to the expected format
-        positions = []
-        for pos in optimize_request.positions:
-            positions.append(Position(
-                symbol=pos.symbol,
-                quantity=pos.quantity,
-                cost_basis=pos.cost_basis,
-                purchase_date=pos.purchase_date
-            ))
-        
-        # Call the agent
-        result = await agent.optimize_portfolio(
-            positions=positions,
-            risk_tolerance=optimize_request.risk_tolerance,
-            investment_horizon=optimize_request.investment_horizon,
-            additional_capital=optimize_request.additional_capital,
-            constraints=optimize_request.constraints
-        )
+        result = await _run_portfolio_optimization(agent, optimize_request)
         
         # Store analysis result
-        analysis = AnalysisResult(
-            user_id=user_id,
-            agent_id="portfolio_agent",
-            result_type="portfolio_optimization",
-            input_data=optimize_request.dict(),
-            result_data=result,
-            is_saved=False
-        )
-        db.add(analysis)
-        db.commit()
-        db.refresh(analysis)
+        analysis = await _persist_analysis(db, user_id, "portfolio_optimization", optimize_request.dict(), result)
         
         # Track usage
         background_tasks.add_task(
@@ -340,21 +518,11 @@ async def optimize_portfolio(
             user_agent_id=user_agent.id,
             subscription_id=subscription.id if subscription else None,
             request_count=1,
-            token_count=len(str(result)) // 4,  # Rough estimate of token count
-            db=db
+            db=db,
+            result=result
         )
         
-        return {
-            "id": analysis.id,
-            "user_id": analysis.user_id,
-            "agent_id": analysis.agent_id,
-            "created_at": analysis.created_at.isoformat(),
-            "result_type": analysis.result_type,
-            "input_data": analysis.input_data,
-            "result_data": analysis.result_data,
-            "is_saved": analysis.is_saved,
-            "name": analysis.name
-        }
+        return _analysis_fields_response(analysis, fields)
     except Exception as e:
         logger.error(f"Error optimizing portfolio: {str(e)}")
         raise HTTPException(
@@ -362,16 +530,23 @@ async def optimize_portfolio(
             detail=f"Failed to optimize portfolio: {str(e)}"
         )
 
-@router.post("/risk", response_model=AnalysisResponse)
+@router.post("/risk", response_model=AnalysisResponse, responses=_ANALYSIS_JOB_RESPONSES)
 async def analyze_risk(
     risk_request: RiskAnalysisRequest,
     background_tasks: BackgroundTasks,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    run_async: bool = False,
+    fields: Optional[str] = None,
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Analyze portfolio risk
     """
+    if run_async:
+        return await _enqueue_analysis_job(
+            db, background_tasks, user_data, "risk_analysis", risk_request, _run_risk_analysis
+        )
+    
     user_id = user_data["user"].id
     user_agent = user_data["user_agent"]
     subscription = user_data["subscription"]
@@ -379,36 +554,10 @@ async def analyze_risk(
     try:
         # Get portfolio agent instance
         agent = await get_agent_instance("portfolio_agent")
-        
-        # Convert positions to the expected format
-        positions = []
-        for pos in risk_request.positions:
-            positions.append(Position(
-                symbol=pos.symbol,
-                quantity=pos.quantity,
-                cost_basis=pos.cost_basis,
-                purchase_date=pos.purchase_date
-            ))
-        
-        # Call the agent
-        result = await agent.analyze_risk(
-            positions=positions,
-            var_confidence=risk_request.var_confidence,
-            stress_test=risk_request.stress_test
-        )
+        result = await _run_risk_analysis(agent, risk_request)
         
         # Store analysis result
-        analysis = AnalysisResult(
-            user_id=user_id,
-            agent_id="portfolio_agent",
-            result_type="risk_analysis",
-            input_data=risk_request.dict(),
-            result_data=result,
-            is_saved=False
-        )
-        db.add(analysis)
-        db.commit()
-        db.refresh(analysis)
+        analysis = await _persist_analysis(db, user_id, "risk_analysis", risk_request.dict(), result)
         
         # Track usage
         background_tasks.add_task(
@@ -416,21 +565,11 @@ async def analyze_risk(
             user_agent_id=user_agent.id,
             subscription_id=subscription.id if subscription else None,
             request_count=1,
-            token_count=len(str(result)) // 4,  # Rough estimate of token count
-            db=db
+            db=db,
+            result=result
         )
         
-        return {
-            "id": analysis.id,
-            "user_id": analysis.user_id,
-            "agent_id": analysis.agent_id,
-            "created_at": analysis.created_at.isoformat(),
-            "result_type": analysis.result_type,
-            "input_data": analysis.input_data,
-            "result_data": analysis.result_data,
-            "is_saved": analysis.is_saved,
-            "name": analysis.name
-        }
+        return _analysis_fields_response(analysis, fields)
     except Exception as e:
         logger.error(f"Error analyzing portfolio risk: {str(e)}")
         raise HTTPException(
@@ -441,18 +580,19 @@ async def analyze_risk(
 @router.get("/analysis/{analysis_id}", response_model=AnalysisResponse)
 async def get_analysis(
     analysis_id: int,
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db)
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get an analysis result by ID
     """
     user_id = user_data["user"].id
     
-    analysis = db.query(AnalysisResult).filter(
+    result = await db.execute(select(AnalysisResult).where(
         AnalysisResult.id == analysis_id,
         AnalysisResult.user_id == user_id
-    ).first()
+    ))
+    analysis = result.scalars().first()
     
     if not analysis:
         raise HTTPException(
@@ -460,52 +600,33 @@ async def get_analysis(
             detail="Analysis not found"
         )
     
-    return {
-        "id": analysis.id,
-        "user_id": analysis.user_id,
-        "agent_id": analysis.agent_id,
-        "created_at": analysis.created_at.isoformat(),
-        "result_type": analysis.result_type,
-        "input_data": analysis.input_data,
-        "result_data": analysis.result_data,
-        "is_saved": analysis.is_saved,
-        "name": analysis.name
-    }
+    return AnalysisResponse.from_orm(analysis)
 
-@router.get("/analysis", response_model=List[AnalysisResponse])
-async def list_analyses(
-    user_data: Dict[str, Any] = Depends(check_agent_access),
-    db: Session = Depends(get_db),
-    limit: int = 10,
-    offset: int = 0,
-    agent_id: Optional[str] = None,
-    result_type: Optional[str] = None
+@router.get("/analysis/job/{job_id}")
+async def get_analysis_job(
+    job_id: int,
+    user_data: Dict[str, Any] = Depends(check_portfolio_access),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
-    List analysis results for the current user
+    Get the status of a queued analysis
     """
-    user_id = user_data["user"].id
-    
-    query = db.query(AnalysisResult).filter(AnalysisResult.user_id == user_id)
-    
-    if agent_id:
-        query = query.filter(AnalysisResult.agent_id == agent_id)
-    
-    if result_type:
-        query = query.filter(AnalysisResult.result_type == result_type)
+    result = await db.execute(select(Task).where(
+        Task.id == job_id,
+        Task.user_id == user_data["user"].id
+    ))
+    task = result.scalars().first()
     
-    analyses = query.order_by(AnalysisResult.created_at.desc()).offset(offset).limit(limit).all()
+    if not task:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Analysis job not found"
+        )
     
-    return [
-        {
-            "id": analysis.id,
-            "user_id": analysis.user_id,
-            "agent_id": analysis.agent_id,
-            "created_at": analysis.created_at.isoformat(),
-            "result_type": analysis.result_type,
-            "input_data": analysis.input_data,
-            "result_data": analysis.result_data,
-            "is_saved": analysis.is_saved,
-            "name": analysis.name
-        } for analysis in analyses
-    ] 
\ No newline at end of file
+    return {
+        "job_id": task.id,
+        "task_type": task.task_type,
+        "status": task.status,
+        "analysis_id": task.result.get("analysis_id") if task.result else None,
+        "error": task.error
+    }
@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models import AgentPurchase
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
+from app.database import get_async_db
+from app.auth import get_current_active_user
+from app.models import AgentPurchase, User
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/api/purchases", tags=["purchases"])
@@ -13,8 +16,13 @@ class PurchaseRequest(BaseModel):
     currency: str = "USD"
 
 @router.post("/")
-def purchase_agent(request: PurchaseRequest, db: Session = Depends(get_db)):
+async def purchase_agent(
+    request: PurchaseRequest,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
     purchase = AgentPurchase(
+        buyer_id=user.id,
         agent_id=request.agent_id,
         pricing_tier_id=request.pricing_tier_id,
         amount=request.amount,
@@ -22,10 +30,21 @@ def purchase_agent(request: PurchaseRequest, db: Session = Depends(get_db)):
         transaction_id="demo-txid"
     )
     db.add(purchase)
-    db.commit()
-    db.refresh(purchase)
+    await db.commit()
+    await db.refresh(purchase)
     return purchase
 
 @router.get("/")
-def list_purchases(db: Session = Depends(get_db)):
-    return db.query(AgentPurchase).all() 
\ No newline at end of file
+async def list_purchases(
+    limit: int = 50,
+    offset: int = 0,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    condition = AgentPurchase.buyer_id == user.id
+    result = await db.execute(
+        select(AgentPurchase).where(condition).options(raiseload("*"))
+        .order_by(AgentPurchase.id.desc()).offset(offset).limit(limit)
+    )
+    total = await db.scalar(select(func.count(AgentPurchase.id)).where(condition))
+    return {"items": result.scalars().all(), "total": total} 
\ No newline at end of file
@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models import AgentReview
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
+from app.database import get_async_db
+from app.auth import get_current_active_user
+from app.models import AgentReview, User
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/api/reviews", tags=["reviews"])
@@ -14,20 +17,30 @@ class ReviewRequest(BaseModel):
     content: str = None
 
 @router.post("/")
-def create_review(request: ReviewRequest, db: Session = Depends(get_db)):
+async def create_review(
+    request: ReviewRequest,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
     review = AgentReview(
         agent_id=request.agent_id,
         purchase_id=request.purchase_id,
         rating=request.rating,
         title=request.title,
         content=request.content,
-        reviewer_id=1  # TODO: Use current user
+        reviewer_id=user.id
     )
     db.add(review)
-    db.commit()
-    db.refresh(review)
+    await db.commit()
+    await db.refresh(review)
     return review
 
 @router.get("/by-agent/{agent_id}")
-def list_reviews_by_agent(agent_id: int, db: Session = Depends(get_db)):
-    return db.query(AgentReview).filter(AgentReview.agent_id == agent_id).all() 
\ No newline at end of file
+async def list_reviews_by_agent(agent_id: int, limit: int = 50, offset: int = 0, db: AsyncSession = Depends(get_async_db)):
+    condition = AgentReview.agent_id == agent_id
+    result = await db.execute(
+        select(AgentReview).where(condition).options(raiseload("*"))
+        .order_by(AgentReview.id.desc()).offset(offset).limit(limit)
+    )
+    total = await db.scalar(select(func.count(AgentReview.id)).where(condition))
+    return {"items": result.scalars().all(), "total": total} 
\ No newline at end of file
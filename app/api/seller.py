@@ -1,23 +1,53 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models import AgentListing
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only, raiseload
+from app.database import get_async_db
+from app.auth import get_current_active_user
+from app.models import AgentListing, User
+from app.api.agents import LISTING_SUMMARY_COLUMNS
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/api/seller", tags=["seller"])
 
+# Listing summary plus the fields a seller tracks for their own agents
+SELLER_LISTING_COLUMNS = LISTING_SUMMARY_COLUMNS + (
+    AgentListing.status,
+    AgentListing.view_count,
+    AgentListing.purchase_count,
+    AgentListing.updated_at,
+)
+
 class AgentUpdateRequest(BaseModel):
     name: str = None
     short_description: str = None
     category: str = None
 
 @router.get("/my-agents")
-def list_my_agents(db: Session = Depends(get_db)):
-    return db.query(AgentListing).filter(AgentListing.seller_id == 1).all()  # TODO: Use current user
+async def list_my_agents(
+    limit: int = 50,
+    offset: int = 0,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    condition = AgentListing.seller_id == user.id
+    result = await db.execute(
+        select(AgentListing).where(condition)
+        .options(load_only(*SELLER_LISTING_COLUMNS), raiseload("*"))
+        .order_by(AgentListing.id.desc()).offset(offset).limit(limit)
+    )
+    total = await db.scalar(select(func.count(AgentListing.id)).where(condition))
+    return {"items": result.scalars().all(), "total": total}
 
 @router.put("/agent/{agent_id}")
-def update_agent(agent_id: int, request: AgentUpdateRequest, db: Session = Depends(get_db)):
-    agent = db.query(AgentListing).filter(AgentListing.id == agent_id, AgentListing.seller_id == 1).first()
+async def update_agent(
+    agent_id: int,
+    request: AgentUpdateRequest,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await db.execute(select(AgentListing).where(AgentListing.id == agent_id, AgentListing.seller_id == user.id))
+    agent = result.scalars().first()
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
     if request.name:
@@ -26,15 +56,19 @@ def update_agent(agent_id: int, request: AgentUpdateRequest, db: Session = Depen
         agent.short_description = request.short_description
     if request.category:
         agent.category = request.category
-    db.commit()
-    db.refresh(agent)
+    await db.commit()
     return agent
 
 @router.delete("/agent/{agent_id}")
-def delete_agent(agent_id: int, db: Session = Depends(get_db)):
-    agent = db.query(AgentListing).filter(AgentListing.id == agent_id, AgentListing.seller_id == 1).first()
+async def delete_agent(
+    agent_id: int,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await db.execute(select(AgentListing).where(AgentListing.id == agent_id, AgentListing.seller_id == user.id))
+    agent = result.scalars().first()
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    db.delete(agent)
-    db.commit()
+    await db.delete(agent)
+    await db.commit()
     return {"deleted": True} 
\ No newline at end of file
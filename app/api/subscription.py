@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from typing import Dict, Any, List, Optional
-from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Any, List, Literal, Optional, Tuple
+from pydantic import BaseModel, Field
+from datetime import datetime
 import logging
 
-from app.database import get_db
+from app.database import get_async_db, dialect_insert
 from app.auth import get_current_active_user, get_subscription_user
+from app.cache import TTLCache
 from app.stripe import (
     create_stripe_customer,
     create_subscription,
@@ -14,7 +16,8 @@ from app.stripe import (
     get_stripe_publishable_key,
     get_subscription_plans
 )
-from app.models import User, Subscription, SubscriptionTier
+from app.config import settings
+from app.models import User, Subscription, SubscriptionTier, UserAgent
 
 logger = logging.getLogger(__name__)
 
@@ -23,20 +26,29 @@ router = APIRouter()
 class PaymentMethodCreate(BaseModel):
     payment_method_id: str
 
+# Only configured Stripe price ids validate; with none configured any id is passed through
+PriceId = Literal[tuple(settings.SUBSCRIPTION_PRICE_TIERS)] if settings.SUBSCRIPTION_PRICE_TIERS else str
+
 class SubscriptionCreate(BaseModel):
     payment_method_id: str
-    price_id: str
+    price_id: PriceId
+    # Optionally generated by the client once per subscribe attempt and resent on its retries;
+    # see _subscribe_attempt_key for the key used without one
+    request_id: Optional[str] = Field(None, max_length=64)
 
 class SubscriptionResponse(BaseModel):
     id: Optional[int] = None
     tier: str
     is_active: bool
-    started_at: Optional[str] = None
-    ended_at: Optional[str] = None
+    started_at: Optional[datetime] = None
+    ended_at: Optional[datetime] = None
     auto_renew: Optional[bool] = None
     stripe_subscription_id: Optional[str] = None
     client_secret: Optional[str] = None
 
+    class Config:
+        orm_mode = True
+
 class SubscriptionPlan(BaseModel):
     id: str
     name: str
@@ -52,13 +64,20 @@ async def get_plans():
     """
     return await get_subscription_plans()
 
+# The publishable key changes rarely and is requested on every page load
+_STRIPE_CONFIG_CACHE = TTLCache(maxsize=1, ttl=3600)
+
 @router.get("/config")
 async def get_subscription_config():
     """
     Get subscription configuration for client-side use
     """
+    publishable_key = _STRIPE_CONFIG_CACHE.get("publishable_key")
+    if publishable_key is None:
+        publishable_key = await get_stripe_publishable_key()
+        _STRIPE_CONFIG_CACHE.set("publishable_key", publishable_key)
     return {
-        "publishable_key": await get_stripe_publishable_key()
+        "publishable_key": publishable_key
     }
 
 @router.get("/my", response_model=SubscriptionResponse)
@@ -76,21 +95,76 @@ async def get_my_subscription(user_data: Dict[str, Any] = Depends(get_subscripti
             "auto_renew": False
         }
     
-    return {
-        "id": subscription.id,
-        "tier": subscription.tier,
-        "is_active": subscription.is_active,
-        "started_at": subscription.started_at.isoformat() if subscription.started_at else None,
-        "ended_at": subscription.ended_at.isoformat() if subscription.ended_at else None,
-        "auto_renew": subscription.auto_renew,
-        "stripe_subscription_id": subscription.stripe_subscription_id
-    }
+    return SubscriptionResponse.from_orm(subscription)
+
+def _subscribe_attempt_key(
+    user: User,
+    current_subscription: Optional[Subscription],
+    subscription_data: SubscriptionCreate
+) -> str:
+    """
+    Idempotency key for a subscribe attempt, scoped to the user, so Stripe returns the first
+    attempt's customer and subscription to its retries instead of creating new ones
+    """
+    if subscription_data.request_id:
+        return f"{user.id}-{subscription_data.request_id}"
+    # Without a client request id, retries are recognized by their parameters and the user's current
+    # subscription row, which changes once a subscription is created or ends (so a later
+    # resubscribe with the same card and plan is a new attempt)
+    current = f"{current_subscription.id}-{current_subscription.stripe_subscription_id}" if current_subscription else "none"
+    return f"{user.id}-{subscription_data.price_id}-{subscription_data.payment_method_id}-{current}"
+
+async def _create_stripe_subscription(
+    user: User,
+    current_subscription: Optional[Subscription],
+    subscription_data: SubscriptionCreate
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Create the Stripe subscription, creating the customer first if needed
+    """
+    attempt_key = _subscribe_attempt_key(user, current_subscription, subscription_data)
+    
+    # Create or get Stripe customer; a new customer is created with the payment method attached
+    if current_subscription and current_subscription.stripe_customer_id:
+        customer_id = current_subscription.stripe_customer_id
+        new_customer = False
+    else:
+        customer = await create_stripe_customer(
+            user, subscription_data.payment_method_id, idempotency_key=attempt_key
+        )
+        customer_id = customer["customer_id"]
+        new_customer = True
+    
+    # Create subscription in Stripe
+    stripe_subscription = await create_subscription(
+        customer_id,
+        subscription_data.price_id,
+        subscription_data.payment_method_id,
+        attach_payment_method=not new_customer,
+        idempotency_key=attempt_key
+    )
+    return customer_id, stripe_subscription
+
+async def _enable_tier_agents(db: AsyncSession, user_id: int, agent_ids: List[str]):
+    """
+    Add the user agents the user doesn't have yet for a tier, in one statement
+    """
+    if not agent_ids:
+        return
+    await db.execute(
+        dialect_insert(db, UserAgent)
+        .values([
+            {"user_id": user_id, "agent_id": agent_id, "is_enabled": True}
+            for agent_id in agent_ids
+        ])
+        .on_conflict_do_nothing(index_elements=[UserAgent.user_id, UserAgent.agent_id])
+    )
 
 @router.post("/create", response_model=SubscriptionResponse)
 async def create_new_subscription(
     subscription_data: SubscriptionCreate,
     user_data: Dict[str, Any] = Depends(get_subscription_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Create a new subscription for the current user
@@ -106,37 +180,32 @@ async def create_new_subscription(
         )
     
     try:
-        # Create or get Stripe customer
-        if current_subscription and current_subscription.stripe_customer_id:
-            customer_id = current_subscription.stripe_customer_id
-        else:
-            customer = await create_stripe_customer(user, subscription_data.payment_method_id)
-            customer_id = customer["customer_id"]
-        
-        # Create subscription in Stripe
-        stripe_subscription = await create_subscription(
-            customer_id,
-            subscription_data.price_id,
-            subscription_data.payment_method_id
+        # Determine subscription tier from price ID
+        tier = settings.SUBSCRIPTION_PRICE_TIERS.get(
+            subscription_data.price_id, SubscriptionTier.PROFESSIONAL.value  # Default
         )
+        # The user's agents were loaded with the user, so no read is needed before Stripe
+        enabled_agents = {user_agent.agent_id for user_agent in user.user_agents}
+        missing_agents = [
+            agent_id for agent_id in settings.SUBSCRIPTION_TIERS.get(tier, {}).get("agents", [])
+            if agent_id not in enabled_agents
+        ]
         
-        # Determine subscription tier from price ID
-        tier = SubscriptionTier.PROFESSIONAL.value  # Default
-        for tier_id, tier_data in settings.SUBSCRIPTION_TIERS.items():
-            if tier_data.get("price_id") == subscription_data.price_id:
-                tier = tier_id
-                break
+        customer_id, stripe_subscription = await _create_stripe_subscription(user, current_subscription, subscription_data)
+        
+        # Write only once Stripe has succeeded, so no write transaction is held open across its round trips
+        await _enable_tier_agents(db, user.id, missing_agents)
         
         # Create or update subscription in database
         if current_subscription:
             # Update existing subscription
-            current_subscription.tier = tier
-            current_subscription.stripe_subscription_id = stripe_subscription["subscription_id"]
-            current_subscription.is_active = stripe_subscription["status"] in ["active", "trialing"]
-            current_subscription.auto_renew = True
-            current_subscription.stripe_customer_id = customer_id
-            current_subscription.ended_at = None
             db_subscription = current_subscription
+            db_subscription.tier = tier
+            db_subscription.stripe_subscription_id = stripe_subscription["subscription_id"]
+            db_subscription.is_active = stripe_subscription["status"] in ["active", "trialing"]
+            db_subscription.auto_renew = True
+            db_subscription.stripe_customer_id = customer_id
+            db_subscription.ended_at = None
         else:
             # Create new subscription
             db_subscription = Subscription(
@@ -149,39 +218,11 @@ async def create_new_subscription(
             )
             db.add(db_subscription)
         
-        db.commit()
-        db.refresh(db_subscription)
+        await db.commit()
         
-        # Enable agents for the new tier
-        available_agents = settings.SUBSCRIPTION_TIERS.get(tier, {}).get("agents", [])
-        for agent_id in available_agents:
-            # Check if user has this agent
-            user_agent = db.query(UserAgent).filter(
-                UserAgent.user_id == user.id,
-                UserAgent.agent_id == agent_id
-            ).first()
-            
-            if not user_agent:
-                # Create user agent
-                user_agent = UserAgent(
-                    user_id=user.id,
-                    agent_id=agent_id,
-                    is_enabled=True
-                )
-                db.add(user_agent)
-        
-        db.commit()
-        
-        return {
-            "id": db_subscription.id,
-            "tier": db_subscription.tier,
-            "is_active": db_subscription.is_active,
-            "started_at": db_subscription.started_at.isoformat() if db_subscription.started_at else None,
-            "ended_at": db_subscription.ended_at.isoformat() if db_subscription.ended_at else None,
-            "auto_renew": db_subscription.auto_renew,
-            "stripe_subscription_id": db_subscription.stripe_subscription_id,
-            "client_secret": stripe_subscription.get("client_secret")
-        }
+        response = SubscriptionResponse.from_orm(db_subscription)
+        response.client_secret = stripe_subscription.get("client_secret")
+        return response
     except Exception as e:
         logger.error(f"Error creating subscription: {str(e)}")
         raise HTTPException(
@@ -192,7 +233,7 @@ async def create_new_subscription(
 @router.post("/cancel", response_model=SubscriptionResponse)
 async def cancel_current_subscription(
     user_data: Dict[str, Any] = Depends(get_subscription_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Cancel the current user's subscription
@@ -212,7 +253,7 @@ async def cancel_current_subscription(
         
         # Update subscription in database
         subscription.auto_renew = False
-        db.commit()
+        await db.commit()
         
         # Create a new basic subscription (will be activated once current one expires)
         basic_subscription = Subscription(
@@ -222,20 +263,9 @@ async def cancel_current_subscription(
             auto_renew=False
         )
         db.add(basic_subscription)
-        db.commit()
+        await db.commit()
         
-        # Get updated subscription details
-        db.refresh(subscription)
-        
-        return {
-            "id": subscription.id,
-            "tier": subscription.tier,
-            "is_active": subscription.is_active,
-            "started_at": subscription.started_at.isoformat() if subscription.started_at else None,
-            "ended_at": subscription.ended_at.isoformat() if subscription.ended_at else None,
-            "auto_renew": subscription.auto_renew,
-            "stripe_subscription_id": subscription.stripe_subscription_id
-        }
+        return SubscriptionResponse.from_orm(subscription)
     except Exception as e:
         logger.error(f"Error canceling subscription: {str(e)}")
         raise HTTPException(
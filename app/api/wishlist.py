@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models import AgentWishlist
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
+from app.database import get_async_db
+from app.auth import get_current_active_user
+from app.models import AgentWishlist, User
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/api/wishlist", tags=["wishlist"])
@@ -10,21 +13,41 @@ class WishlistRequest(BaseModel):
     agent_id: int
 
 @router.post("/add")
-def add_to_wishlist(request: WishlistRequest, db: Session = Depends(get_db)):
-    wishlist = AgentWishlist(user_id=1, agent_id=request.agent_id)  # TODO: Use current user
+async def add_to_wishlist(
+    request: WishlistRequest,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    wishlist = AgentWishlist(user_id=user.id, agent_id=request.agent_id)
     db.add(wishlist)
-    db.commit()
-    db.refresh(wishlist)
+    await db.commit()
+    await db.refresh(wishlist)
     return wishlist
 
 @router.post("/remove")
-def remove_from_wishlist(request: WishlistRequest, db: Session = Depends(get_db)):
-    wishlist = db.query(AgentWishlist).filter(AgentWishlist.user_id == 1, AgentWishlist.agent_id == request.agent_id).first()
+async def remove_from_wishlist(
+    request: WishlistRequest,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await db.execute(select(AgentWishlist).where(AgentWishlist.user_id == user.id, AgentWishlist.agent_id == request.agent_id))
+    wishlist = result.scalars().first()
     if wishlist:
-        db.delete(wishlist)
-        db.commit()
+        await db.delete(wishlist)
+        await db.commit()
     return {"removed": True}
 
 @router.get("/")
-def list_wishlist(db: Session = Depends(get_db)):
-    return db.query(AgentWishlist).filter(AgentWishlist.user_id == 1).all() 
\ No newline at end of file
+async def list_wishlist(
+    limit: int = 50,
+    offset: int = 0,
+    user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    condition = AgentWishlist.user_id == user.id
+    result = await db.execute(
+        select(AgentWishlist).where(condition).options(raiseload("*"))
+        .order_by(AgentWishlist.id.desc()).offset(offset).limit(limit)
+    )
+    total = await db.scalar(select(func.count(AgentWishlist.id)).where(condition))
+    return {"items": result.scalars().all(), "total": total} 
\ No newline at end of file
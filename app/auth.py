@@ -1,76 +1,109 @@
 from datetime import datetime, timedelta
 from typing import Optional, Union, Dict, Any
-from jose import JWTError, jwt
+import jwt
+from jwt import PyJWTError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from app.config import settings
-from app.database import get_db
+from app.database import get_async_db
+from app.cache import TTLCache
 from app.models import User, Subscription, SubscriptionTier, UserAgent
+import asyncio
+import hashlib
 import logging
 import secrets
-import string
+import time
 
 logger = logging.getLogger(__name__)
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=settings.BCRYPT_ROUNDS, deprecated="auto")
 
-# OAuth2 scheme for token authentication
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_PREFIX}/auth/token")
+# Verified against when no user matches, to keep login timing uniform; shared with app.api.auth
+DUMMY_PASSWORD_HASH = pwd_context.hash("!")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify that a plain password matches a hashed password"""
-    return pwd_context.verify(plain_password, hashed_password)
+# Bearer token scheme; tokens are issued by {API_PREFIX}/auth/token
+bearer_scheme = HTTPBearer()
 
-def get_password_hash(password: str) -> str:
-    """Hash a password for storage"""
-    return pwd_context.hash(password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify that a plain password matches a hashed password, off the event loop"""
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
+
+async def get_password_hash(password: str) -> str:
+    """Hash a password for storage, off the event loop"""
+    return await asyncio.to_thread(pwd_context.hash, password)
 
 def generate_api_key() -> str:
     """Generate a secure API key"""
-    # 32 characters from letters, digits, and safe special chars
-    alphabet = string.ascii_letters + string.digits + "-_"
-    return ''.join(secrets.choice(alphabet) for _ in range(32))
-
-def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
-    """Create a JWT access token"""
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
-
-def get_user_by_email(db: Session, email: str) -> Optional[User]:
+    # 24 random bytes encode to 32 characters from letters, digits, "-" and "_"
+    return secrets.token_urlsafe(24)
+
+def create_access_token(sub: str, expires_delta: Optional[timedelta] = None) -> str:
+    """Create a JWT access token for the given subject"""
+    payload = {
+        "sub": sub,
+        "exp": datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
+    }
+    return jwt.encode(payload, settings.SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+# Built once at import and reused with an "email" bind, so only the compiled-statement cache is consulted
+_USER_BY_EMAIL = select(User).where(User.email == bindparam("email"))
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
     """Get a user by email"""
-    return db.query(User).filter(User.email == email).first()
+    result = await db.execute(_USER_BY_EMAIL, {"email": email})
+    return result.scalar_one_or_none()
+
+# Everything the auth dependencies need, loaded with the user in a single query:
+# the active subscriptions (normally just one) and the user's agent settings
+_auth_context = (
+    joinedload(User.subscriptions.and_(Subscription.is_active == True)),
+    joinedload(User.user_agents),
+)
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+_USER_WITH_AUTH_CONTEXT_BY_EMAIL = _USER_BY_EMAIL.options(*_auth_context)
+
+async def get_user_with_auth_context(db: AsyncSession, email: str) -> Optional[User]:
+    """Get a user by email along with their active subscriptions and user agents"""
+    result = await db.execute(_USER_WITH_AUTH_CONTEXT_BY_EMAIL, {"email": email})
+    return result.unique().scalar_one_or_none()
+
+def _active_subscription(user: User) -> Optional[Subscription]:
+    """The most recent active subscription preloaded on the user"""
+    return max(user.subscriptions, key=lambda s: s.id, default=None)
+
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
     """Authenticate a user by email and password"""
-    user = get_user_by_email(db, email)
+    user = await get_user_by_email(db, email)
     if not user or not user.hashed_password:
+        # Spend the same bcrypt time as a real check so unknown emails aren't distinguishable
+        await verify_password(password, DUMMY_PASSWORD_HASH)
         return None
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return None
     return user
 
-def create_user(db: Session, email: str, password: Optional[str] = None, 
+async def create_user(db: AsyncSession, email: str, password: Optional[str] = None, 
                 first_name: Optional[str] = None, last_name: Optional[str] = None,
                 google_id: Optional[str] = None) -> User:
     """Create a new user"""
     # Check if user already exists
-    existing_user = get_user_by_email(db, email)
+    existing_user = await get_user_by_email(db, email)
     if existing_user:
         if google_id and not existing_user.google_id:
             # Update existing user with Google ID
             existing_user.google_id = google_id
             existing_user.last_login = datetime.utcnow()
-            db.commit()
+            await db.commit()
             return existing_user
         return existing_user
     
     # Create new user
-    hashed_password = get_password_hash(password) if password else None
+    hashed_password = await get_password_hash(password) if password else None
     user = User(
         email=email,
         hashed_password=hashed_password,
@@ -80,28 +113,26 @@ def create_user(db: Session, email: str, password: Optional[str] = None,
         last_login=datetime.utcnow()
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    # Flush for the user id; the user, subscription and agents commit together below
+    await db.flush()
     
     # Create basic subscription
-    create_subscription(db, user.id, SubscriptionTier.BASIC.value)
+    await create_subscription(db, user.id, SubscriptionTier.BASIC.value, commit=False)
     
     # Enable basic agents
-    for agent_id in settings.SUBSCRIPTION_TIERS["basic"]["agents"]:
-        user_agent = UserAgent(
-            user_id=user.id,
-            agent_id=agent_id,
-            is_enabled=True
-        )
-        db.add(user_agent)
+    await db.execute(insert(UserAgent).values([
+        {"user_id": user.id, "agent_id": agent_id, "is_enabled": True}
+        for agent_id in settings.SUBSCRIPTION_TIERS["basic"]["agents"]
+    ]))
     
-    db.commit()
+    await db.commit()
     return user
 
-def create_subscription(db: Session, user_id: int, tier: str = SubscriptionTier.BASIC.value, 
+async def create_subscription(db: AsyncSession, user_id: int, tier: str = SubscriptionTier.BASIC.value, 
                         stripe_customer_id: Optional[str] = None, 
-                        stripe_subscription_id: Optional[str] = None) -> Subscription:
-    """Create a new subscription for a user"""
+                        stripe_subscription_id: Optional[str] = None,
+                        commit: bool = True) -> Subscription:
+    """Create a new subscription for a user, leaving the commit to the caller if commit is False"""
     subscription = Subscription(
         user_id=user_id,
         tier=tier,
@@ -111,26 +142,42 @@ def create_subscription(db: Session, user_id: int, tier: str = SubscriptionTier.
         auto_renew=False if tier == SubscriptionTier.BASIC.value else True
     )
     db.add(subscription)
-    db.commit()
-    db.refresh(subscription)
+    if commit:
+        await db.commit()
     return subscription
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+# Decoded JWT payloads keyed by token hash, each kept until the token's own expiry
+_token_cache = TTLCache(maxsize=10000, ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+def _decode_token(token: str) -> Dict[str, Any]:
+    """Decode and verify a JWT, reusing the result for tokens seen before"""
+    key = hashlib.sha256(token.encode()).digest()
+    payload = _token_cache.get(key)
+    if payload is None:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        exp = payload.get("exp")
+        if exp is not None:
+            _token_cache.set(key, payload, ttl=exp - time.time())
+    return payload
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+                           db: AsyncSession = Depends(get_async_db)) -> User:
     """Get the current user from a JWT token"""
+    token = credentials.credentials
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = _decode_token(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
-    except JWTError:
+    except PyJWTError:
         raise credentials_exception
     
-    user = get_user_by_email(db, email)
+    user = await get_user_with_auth_context(db, email)
     if user is None:
         raise credentials_exception
     
@@ -142,14 +189,10 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-async def get_subscription_user(current_user: User = Depends(get_current_active_user), 
-                              db: Session = Depends(get_db)) -> Dict[str, Any]:
+async def get_subscription_user(current_user: User = Depends(get_current_active_user)) -> Dict[str, Any]:
     """Get user with active subscription information"""
-    # Get active subscription
-    subscription = db.query(Subscription)\
-        .filter(Subscription.user_id == current_user.id, Subscription.is_active == True)\
-        .order_by(Subscription.id.desc())\
-        .first()
+    # Active subscriptions were loaded with the user
+    subscription = _active_subscription(current_user)
     
     return {
         "user": current_user,
@@ -157,29 +200,24 @@ async def get_subscription_user(current_user: User = Depends(get_current_active_
         "tier": subscription.tier if subscription else SubscriptionTier.BASIC.value
     }
 
-async def check_agent_access(user_data: Dict[str, Any] = Depends(get_subscription_user), 
-                           agent_id: str = None, db: Session = Depends(get_db)) -> Dict[str, Any]:
-    """Check if the user has access to a specific agent"""
-    if not agent_id:
-        raise HTTPException(status_code=400, detail="Agent ID not specified")
+async def check_agent_access(agent_id: str, current_user: User = Depends(get_current_active_user), 
+                           db: AsyncSession = Depends(get_async_db)) -> Dict[str, Any]:
+    """Check if the user has access to a specific agent, taken from the {agent_id} path parameter"""
+    user_id = current_user.id
     
-    # Get user's subscription tier
-    tier = user_data["tier"]
-    user_id = user_data["user"].id
+    # The active subscription and agent settings were loaded with the user
+    subscription = _active_subscription(current_user)
+    user_agent = next((ua for ua in current_user.user_agents if ua.agent_id == agent_id), None)
+    tier = subscription.tier if subscription else SubscriptionTier.BASIC.value
     
     # Check if agent is available in tier
-    available_agents = settings.SUBSCRIPTION_TIERS.get(tier, {}).get("agents", [])
-    if agent_id not in available_agents:
+    if agent_id not in settings.SUBSCRIPTION_TIER_AGENT_SETS.get(tier, frozenset()):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"Your subscription tier does not include access to this agent. Please upgrade to access {agent_id}."
         )
     
     # Check if user has agent enabled
-    user_agent = db.query(UserAgent)\
-        .filter(UserAgent.user_id == user_id, UserAgent.agent_id == agent_id)\
-        .first()
-    
     if not user_agent:
         # Create user agent if it doesn't exist
         user_agent = UserAgent(
@@ -188,8 +226,7 @@ async def check_agent_access(user_data: Dict[str, Any] = Depends(get_subscriptio
             is_enabled=True
         )
         db.add(user_agent)
-        db.commit()
-        db.refresh(user_agent)
+        await db.commit()
     elif not user_agent.is_enabled:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -198,12 +235,19 @@ async def check_agent_access(user_data: Dict[str, Any] = Depends(get_subscriptio
     
     # All checks passed
     return {
-        "user": user_data["user"],
-        "subscription": user_data["subscription"],
+        "user": current_user,
+        "subscription": subscription,
         "tier": tier,
         "user_agent": user_agent
     }
 
+def require_agent_access(agent_id: str):
+    """Build a check_agent_access dependency for a fixed agent, for routers serving a single agent"""
+    async def agent_access(current_user: User = Depends(get_current_active_user),
+                           db: AsyncSession = Depends(get_async_db)) -> Dict[str, Any]:
+        return await check_agent_access(agent_id, current_user, db)
+    return agent_access
+
 # Admin-only dependency
 async def get_admin_user(current_user: User = Depends(get_current_active_user)) -> User:
     """Check that the current user is an admin"""
@@ -1,10 +1,19 @@
 import os
 from dotenv import load_dotenv
-from typing import Dict, List, Any, Optional
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Any, Mapping, Optional
 
 # Load environment variables from .env file
 load_dotenv()
 
+def _freeze(value: Any) -> Any:
+    """Recursively make config data read-only: dicts become mapping proxies, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
 class Settings:
     # App settings
     APP_NAME = "FinTech AI Suite"
@@ -14,14 +23,24 @@ class Settings:
     SECRET_KEY = os.getenv("SECRET_KEY", "changethiskeyinproduction!")
     JWT_ALGORITHM = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
+    BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # e.g. 4 for local development
     
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./fintech.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "25"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "25"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds
+    DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
     
     # Stripe integration
     STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
     STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
     STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY", "")
+    STRIPE_PRICE_ID_PRO = os.getenv("STRIPE_PRICE_ID_PRO")
+    STRIPE_PRICE_ID_ENTERPRISE = os.getenv("STRIPE_PRICE_ID_ENTERPRISE")
+    # Concurrent webhook workers, each using at most one DB session; more than one
+    # only helps on PostgreSQL, where workers claim disjoint batches
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
     
     # OpenRouter API (for LLM capabilities)
     OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
@@ -32,7 +51,8 @@ class Settings:
     GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", "")
     
     # Subscription tiers
-    SUBSCRIPTION_TIERS: Dict[str, Dict[str, Any]] = {
+    # Shared, read-only tier config
+    SUBSCRIPTION_TIERS: Mapping[str, Mapping[str, Any]] = _freeze({
         "basic": {
             "name": "Basic",
             "monthly_price": 0.00,
@@ -63,7 +83,7 @@ class Settings:
                 "options_strategy_agent",
                 "etf_screener_agent",
             ],
-            "price_id": os.getenv("STRIPE_PRICE_ID_PRO")
+            "price_id": STRIPE_PRICE_ID_PRO
         },
         "enterprise": {
             "name": "Enterprise",
@@ -88,8 +108,21 @@ class Settings:
                 "tradeagent",
                 "portfolioadvisoragent"
             ],
-            "price_id": os.getenv("STRIPE_PRICE_ID_ENTERPRISE")
+            "price_id": STRIPE_PRICE_ID_ENTERPRISE
         }
+    })
+    
+    # Agent ids per tier as frozensets for O(1) membership checks
+    SUBSCRIPTION_TIER_AGENT_SETS: Dict[str, FrozenSet[str]] = {
+        tier_id: frozenset(tier_data["agents"])
+        for tier_id, tier_data in SUBSCRIPTION_TIERS.items()
+    }
+    
+    # Tier for each configured Stripe price id
+    SUBSCRIPTION_PRICE_TIERS: Dict[str, str] = {
+        tier_data["price_id"]: tier_id
+        for tier_id, tier_data in SUBSCRIPTION_TIERS.items()
+        if tier_data.get("price_id")
     }
 
 settings = Settings() 
\ No newline at end of file
@@ -1,20 +1,91 @@
-from sqlalchemy import create_engine
+import logging
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Async driver for each sync URL scheme (asyncpg needs to be installed for PostgreSQL)
+_ASYNC_DRIVERS = {
+    "postgresql://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+}
+
+def async_database_url(url: str) -> str:
+    """Rewrite a sync database URL to use the matching async driver"""
+    for scheme, async_scheme in _ASYNC_DRIVERS.items():
+        if url.startswith(scheme):
+            return async_scheme + url[len(scheme):]
+    return url
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./ai_marketplace.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = async_database_url(SQLALCHEMY_DATABASE_URL)
+
+# File-backed SQLite defaults to NullPool (a new connection per session),
+# so both engines get an explicitly sized, process-wide queue pool
+POOL_OPTIONS = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_pre_ping": True,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_timeout": 10,
+}
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    **POOL_OPTIONS
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for endpoints that run on the event loop
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, **POOL_OPTIONS
+)
+AsyncSessionLocal = sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
 
+# Log statements slower than settings.DB_SLOW_QUERY_MS, for both engines
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+    if elapsed_ms >= settings.DB_SLOW_QUERY_MS:
+        logger.warning(f"Slow query ({elapsed_ms:.0f} ms): {statement}")
+
+# Dialect-specific INSERT constructs that support ON CONFLICT
+_UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+def dialect_insert(db, model):
+    """Build an INSERT for the session's dialect, exposing on_conflict_do_* clauses"""
+    return _UPSERT_INSERTS[db.bind.dialect.name](model)
+
 # Dependency
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,10 +1,37 @@
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+
 from app.database import engine
 from app.models import Base
 
+logger = logging.getLogger(__name__)
+
 def init_db():
+    """
+    Create missing tables, and the indexes declared since an existing database was created.
+
+    There are no migrations: an index whose columns the live table doesn't have yet is
+    skipped, and a new unique index (e.g. ix_user_agent_user_agent, ix_usage_agent_sub_period)
+    can't be built while the table holds duplicate rows, so those must be removed first.
+    """
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist, so add any indexes declared since
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        live_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            missing = [column.name for column in index.columns if column.name not in live_columns]
+            if missing:
+                logger.warning(f"Skipping index {index.name}: {table.name} has no column(s) {', '.join(missing)}")
+                continue
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except (IntegrityError, OperationalError) as e:
+                logger.warning(f"Could not create index {index.name} (remove duplicate rows for a unique index): {e}")
 
 if __name__ == "__main__":
     print("Creating database tables...")
     init_db()
-    print("Database tables created successfully!") 
\ No newline at end of file
+    print("Database tables created successfully!")
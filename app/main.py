@@ -2,6 +2,10 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from app.api import auth_router
+from app.api.agents import warm_agent_modules
+from app.database import async_engine, AsyncSessionLocal
+from app.models import WebhookEvent
+from app.stripe import start_webhook_workers
 
 app = FastAPI(
     title="AI Agent Marketplace",
@@ -24,6 +28,27 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Include routers
 app.include_router(auth_router)
 
+@app.on_event("startup")
+async def preload_agents():
+    await warm_agent_modules()
+
+@app.on_event("startup")
+async def start_webhook_processing():
+    # Databases created before webhook_events existed only get it from init_db, which isn't run on startup
+    async with async_engine.begin() as conn:
+        await conn.run_sync(WebhookEvent.__table__.create, checkfirst=True)
+    app.state.webhook_workers = start_webhook_workers(AsyncSessionLocal)
+
+@app.on_event("shutdown")
+async def stop_webhook_processing():
+    for worker in app.state.webhook_workers:
+        worker.cancel()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    # Pooled aiosqlite connections each hold a worker thread until disposed
+    await async_engine.dispose()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to AI Agent Marketplace API"} 
\ No newline at end of file
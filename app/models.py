@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Text, JSON, Enum, Numeric
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Text, JSON, Enum, Numeric, Index, DDL, event, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import enum
 from app.database import Base
 
+# JSON stored as binary JSONB on PostgreSQL, so it can be GIN-indexed for containment filters
+SearchableJSON = JSON().with_variant(JSONB(), "postgresql")
+
 class SubscriptionTier(enum.Enum):
     BASIC = "basic"
     PROFESSIONAL = "professional"
@@ -11,6 +15,8 @@ class SubscriptionTier(enum.Enum):
 
 class User(Base):
     __tablename__ = "users"
+    # Fetch database-generated defaults as part of the INSERT (RETURNING on PostgreSQL)
+    __mapper_args__ = {"eager_defaults": True}
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=True)
@@ -20,7 +26,7 @@ class User(Base):
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
     profile_image = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     last_login = Column(DateTime, nullable=True)
 
     # Relationships
@@ -30,13 +36,18 @@ class User(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    # Fetch database-generated defaults as part of the INSERT (RETURNING on PostgreSQL)
+    __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        Index("ix_sub_user_active_id", "user_id", "is_active", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     tier = Column(String, default=SubscriptionTier.BASIC.value)
     stripe_customer_id = Column(String, unique=True, nullable=True)
     stripe_subscription_id = Column(String, unique=True, nullable=True)
     is_active = Column(Boolean, default=False)
-    started_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     ended_at = Column(DateTime, nullable=True)
     auto_renew = Column(Boolean, default=True)
     payment_method_id = Column(String, nullable=True)
@@ -54,7 +65,7 @@ class ApiKey(Base):
     key = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     expires_at = Column(DateTime, nullable=True)
     last_used = Column(DateTime, nullable=True)
     
@@ -63,12 +74,17 @@ class ApiKey(Base):
 
 class UserAgent(Base):
     __tablename__ = "user_agents"
+    # Fetch database-generated defaults as part of the INSERT (RETURNING on PostgreSQL)
+    __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        Index("ix_user_agent_user_agent", "user_id", "agent_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     agent_id = Column(String, nullable=False)  # e.g., "portfolio_agent", "options_strategy_agent"
     is_enabled = Column(Boolean, default=True)
     custom_settings = Column(JSON, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="user_agents")
@@ -76,6 +92,9 @@ class UserAgent(Base):
 
 class AgentUsage(Base):
     __tablename__ = "agent_usage"
+    __table_args__ = (
+        Index("ix_usage_agent_sub_period", "user_agent_id", "subscription_id", "year", "month", unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_agent_id = Column(Integer, ForeignKey("user_agents.id"))
     subscription_id = Column(Integer, ForeignKey("subscriptions.id"))
@@ -91,17 +110,22 @@ class AgentUsage(Base):
 
 class PortfolioRecord(Base):
     __tablename__ = "portfolio_records"
+    # Fetch the database-stamped updated_at as part of each flush
+    __mapper_args__ = {"eager_defaults": True}
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     name = Column(String, nullable=False)
     description = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=func.now())
     data = Column(JSON, nullable=False)  # JSON containing positions, etc.
     is_public = Column(Boolean, default=False)
 
 class AnalysisResult(Base):
     __tablename__ = "analysis_results"
+    __table_args__ = (
+        Index("ix_analysis_user_created", "user_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     agent_id = Column(String, nullable=False)
@@ -125,8 +149,24 @@ class Task(Base):
     result = Column(JSON, nullable=True)
     error = Column(Text, nullable=True)
 
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+    __table_args__ = (
+        Index("ix_webhook_pending", "processed_at", "id"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String, unique=True, nullable=False)  # Stripe event id, e.g. "evt_..."
+    type = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+
 class AgentListing(Base):
     __tablename__ = "agent_listings"
+    __table_args__ = (
+        Index("ix_listing_seller_id", "seller_id", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     seller_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
@@ -136,13 +176,13 @@ class AgentListing(Base):
     detailed_description = Column(Text, nullable=True)
     category = Column(String(50), nullable=False, index=True)
     subcategory = Column(String(50), nullable=True)
-    tags = Column(JSON, nullable=True)  # Array of strings
+    tags = Column(SearchableJSON, nullable=True)  # Array of strings
     
     # Technical Specifications
     model_architecture = Column(String(100), nullable=True)
-    supported_languages = Column(JSON, nullable=True)  # Array of language codes
+    supported_languages = Column(SearchableJSON, nullable=True)  # Array of language codes
     api_documentation = Column(Text, nullable=True)
-    technical_requirements = Column(JSON, nullable=True)
+    technical_requirements = Column(SearchableJSON, nullable=True)
     integration_complexity = Column(String(20), nullable=True)  # easy, medium, complex
     
     # Pricing
@@ -157,7 +197,7 @@ class AgentListing(Base):
     
     # Media and Demo
     logo_url = Column(String(500), nullable=True)
-    screenshot_urls = Column(JSON, nullable=True)  # Array of URLs
+    screenshot_urls = Column(SearchableJSON, nullable=True)  # Array of URLs
     video_demo_url = Column(String(500), nullable=True)
     demo_api_endpoint = Column(String(500), nullable=True)
     
@@ -178,7 +218,7 @@ class AgentListing(Base):
     slug = Column(String(255), unique=True, nullable=True, index=True)
     meta_title = Column(String(255), nullable=True)
     meta_description = Column(String(500), nullable=True)
-    search_keywords = Column(JSON, nullable=True)
+    search_keywords = Column(SearchableJSON, nullable=True)
     
     # Analytics
     view_count = Column(Integer, default=0)
@@ -198,6 +238,13 @@ class AgentListing(Base):
     purchases = relationship("AgentPurchase", back_populates="agent")
     analytics = relationship("AgentAnalytics", back_populates="agent", cascade="all, delete-orphan")
 
+# GIN index for tag containment filters; PostgreSQL only, as SQLite has no GIN
+event.listen(
+    AgentListing.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_agent_tags_gin ON agent_listings USING gin (tags)").execute_if(dialect="postgresql")
+)
+
 class AgentPricingTier(Base):
     __tablename__ = "agent_pricing_tiers"
     id = Column(Integer, primary_key=True, index=True)
@@ -219,6 +266,9 @@ class AgentPricingTier(Base):
 
 class AgentPurchase(Base):
     __tablename__ = "agent_purchases"
+    __table_args__ = (
+        Index("ix_purchase_buyer_id", "buyer_id", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     buyer_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     agent_id = Column(Integer, ForeignKey("agent_listings.id"), nullable=False)
@@ -258,6 +308,9 @@ class AgentPurchase(Base):
 
 class AgentReview(Base):
     __tablename__ = "agent_reviews"
+    __table_args__ = (
+        Index("ix_review_agent_id", "agent_id", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     agent_id = Column(Integer, ForeignKey("agent_listings.id"), nullable=False)
     reviewer_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -319,6 +372,9 @@ class AgentAnalytics(Base):
 
 class AgentWishlist(Base):
     __tablename__ = "agent_wishlists"
+    __table_args__ = (
+        Index("ix_wishlist_user_agent", "user_id", "agent_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     agent_id = Column(Integer, ForeignKey("agent_listings.id"), nullable=False)
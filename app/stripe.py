@@ -1,9 +1,14 @@
 import stripe
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Callable, Optional, List
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, insert, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from app.cache import TTLCache
 from app.config import settings
-from app.models import User, Subscription, SubscriptionTier
+from app.database import dialect_insert
+from app.models import User, Subscription, SubscriptionTier, WebhookEvent
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,9 +19,18 @@ if settings.STRIPE_SECRET_KEY:
 else:
     logger.warning("Stripe API key not set. Stripe functionality will not work.")
 
-async def create_stripe_customer(user: User, payment_method_id: Optional[str] = None) -> Dict[str, Any]:
+# One HTTP client for every Stripe call, so its connection pool (and TLS sessions) are reused.
+# The SDK is synchronous, so each call runs in the default thread pool via asyncio.to_thread
+stripe.default_http_client = stripe.http_client.RequestsClient(verify_ssl_certs=True)
+
+def _from_timestamp(timestamp: Optional[int]) -> Optional[datetime]:
+    """Convert a Stripe Unix timestamp to the naive UTC datetimes stored in the database"""
+    return datetime.utcfromtimestamp(timestamp) if timestamp else None
+
+async def create_stripe_customer(user: User, payment_method_id: Optional[str] = None,
+                                 idempotency_key: Optional[str] = None) -> Dict[str, Any]:
     """
-    Create a Stripe customer for a user
+    Create a Stripe customer for a user; requests sharing an idempotency_key create just one
     """
     try:
         customer_data = {
@@ -30,59 +44,65 @@ async def create_stripe_customer(user: User, payment_method_id: Optional[str] =
         if payment_method_id:
             customer_data["payment_method"] = payment_method_id
         
-        customer = stripe.Customer.create(**customer_data)
+        # A repeated request (e.g. a double-click on subscribe) gets the first customer back from Stripe
+        customer = await asyncio.to_thread(
+            stripe.Customer.create,
+            idempotency_key=f"customer-create-{idempotency_key}" if idempotency_key else None,
+            **customer_data
+        )
         
         return {
             "customer_id": customer.id,
             "email": customer.email,
             "name": customer.name
         }
-    except Exception as e:
-        logger.error(f"Error creating Stripe customer: {str(e)}")
+    except Exception:
+        logger.exception("Error creating Stripe customer")
         raise
 
 async def create_subscription(
     customer_id: str, 
     price_id: str,
-    payment_method_id: Optional[str] = None
+    payment_method_id: Optional[str] = None,
+    attach_payment_method: bool = True,
+    idempotency_key: Optional[str] = None
 ) -> Dict[str, Any]:
     """
-    Create a Stripe subscription
+    Create a Stripe subscription, skipping the attach call if the payment method is already the customer's;
+    requests sharing an idempotency_key create just one
     """
     try:
         # Attach payment method to customer if provided
-        if payment_method_id:
-            stripe.PaymentMethod.attach(
+        if payment_method_id and attach_payment_method:
+            await asyncio.to_thread(
+                stripe.PaymentMethod.attach,
                 payment_method_id,
                 customer=customer_id
             )
-            # Set as default payment method
-            stripe.Customer.modify(
-                customer_id,
-                invoice_settings={
-                    "default_payment_method": payment_method_id
-                }
-            )
         
-        # Create subscription
-        subscription = stripe.Subscription.create(
+        # Create subscription, with the payment method as its default
+        subscription_data = {"default_payment_method": payment_method_id} if payment_method_id else {}
+        subscription = await asyncio.to_thread(
+            stripe.Subscription.create,
+            idempotency_key=f"subscription-create-{idempotency_key}" if idempotency_key else None,
             customer=customer_id,
             items=[{"price": price_id}],
             expand=["latest_invoice.payment_intent"],
             payment_behavior="default_incomplete",
             payment_settings={"save_default_payment_method": "on_subscription"},
-            metadata={"price_id": price_id}
+            metadata={"price_id": price_id},
+            **subscription_data
         )
         
         return {
             "subscription_id": subscription.id,
             "status": subscription.status,
-            "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
+            "current_period_end": _from_timestamp(subscription.current_period_end),
             "customer_id": customer_id,
-            "client_secret": subscription.latest_invoice.payment_intent.client_secret if hasattr(subscription, 'latest_invoice') and subscription.latest_invoice else None,
+            "client_secret": ((subscription.get("latest_invoice") or {}).get("payment_intent") or {}).get("client_secret"),
         }
-    except Exception as e:
-        logger.error(f"Error creating Stripe subscription: {str(e)}")
+    except Exception:
+        logger.exception("Error creating Stripe subscription")
         raise
 
 async def cancel_subscription(subscription_id: str) -> Dict[str, Any]:
@@ -90,165 +110,319 @@ async def cancel_subscription(subscription_id: str) -> Dict[str, Any]:
     Cancel a Stripe subscription
     """
     try:
-        subscription = stripe.Subscription.delete(subscription_id)
+        subscription = await asyncio.to_thread(stripe.Subscription.delete, subscription_id)
+        _subscription_details_cache.pop(subscription_id)
         
         return {
             "subscription_id": subscription.id,
             "status": subscription.status,
-            "canceled_at": datetime.fromtimestamp(subscription.canceled_at) if subscription.canceled_at else None
+            "canceled_at": _from_timestamp(subscription.canceled_at)
         }
-    except Exception as e:
-        logger.error(f"Error canceling Stripe subscription: {str(e)}")
+    except Exception:
+        logger.exception("Error canceling Stripe subscription")
         raise
 
+# Subscription details by Stripe subscription id; dropped on cancel and on every subscription webhook
+_subscription_details_cache = TTLCache(maxsize=10000, ttl=600)
+
 async def get_subscription_details(subscription_id: str) -> Dict[str, Any]:
     """
     Get details of a Stripe subscription
     """
+    details = _subscription_details_cache.get(subscription_id)
+    if details is not None:
+        return details
+    
     try:
-        subscription = stripe.Subscription.retrieve(subscription_id)
+        subscription = await asyncio.to_thread(stripe.Subscription.retrieve, subscription_id)
         
-        return {
+        details = {
             "subscription_id": subscription.id,
             "status": subscription.status,
-            "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
-            "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
+            "current_period_start": _from_timestamp(subscription.current_period_start),
+            "current_period_end": _from_timestamp(subscription.current_period_end),
             "cancel_at_period_end": subscription.cancel_at_period_end,
             "customer_id": subscription.customer,
             "price_id": subscription.items.data[0].price.id if subscription.items.data else None,
             "amount": subscription.items.data[0].price.unit_amount / 100 if subscription.items.data and subscription.items.data[0].price.unit_amount else 0,
             "currency": subscription.items.data[0].price.currency if subscription.items.data else None
         }
-    except Exception as e:
-        logger.error(f"Error getting Stripe subscription details: {str(e)}")
+    except Exception:
+        logger.exception("Error getting Stripe subscription details")
         raise
+    
+    _subscription_details_cache.set(subscription_id, details)
+    return details
 
-async def update_subscription_in_db(db: Session, subscription_id: str) -> Optional[Subscription]:
+async def update_subscription_in_db(db: AsyncSession, subscription_id: str) -> bool:
     """
-    Update subscription details in database from Stripe
+    Update subscription details in database from Stripe, returning whether the subscription was found
     """
     try:
-        # Find subscription in DB
-        db_subscription = db.query(Subscription).filter(
-            Subscription.stripe_subscription_id == subscription_id
-        ).first()
-        
-        if not db_subscription:
-            logger.error(f"Subscription {subscription_id} not found in database")
-            return None
-        
         # Get subscription details from Stripe
         subscription_details = await get_subscription_details(subscription_id)
         
-        # Update subscription in DB
-        db_subscription.is_active = subscription_details["status"] in ["active", "trialing"]
-        db_subscription.ended_at = subscription_details["current_period_end"] if subscription_details["cancel_at_period_end"] else None
+        # Update subscription in DB in a single statement
+        result = await db.execute(
+            update(Subscription)
+            .where(Subscription.stripe_subscription_id == subscription_id)
+            .values(
+                is_active=subscription_details["status"] in ["active", "trialing"],
+                ended_at=subscription_details["current_period_end"] if subscription_details["cancel_at_period_end"] else None
+            )
+        )
+        if not result.rowcount:
+            logger.error("Subscription %s not found in database", subscription_id)
+            await db.rollback()
+            return False
         
-        db.commit()
-        return db_subscription
-    except Exception as e:
-        logger.error(f"Error updating subscription in database: {str(e)}")
-        db.rollback()
-        return None
+        await db.commit()
+        return True
+    except Exception:
+        logger.exception("Error updating subscription in database")
+        await db.rollback()
+        return False
 
-async def process_stripe_webhook(event_data: Dict[str, Any], db: Session) -> bool:
+# The only event types applied; the Stripe webhook endpoint should be configured to send just these
+HANDLED_WEBHOOK_EVENTS = frozenset((
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+))
+
+async def process_stripe_webhook(event_data: Dict[str, Any], db: AsyncSession) -> bool:
     """
-    Process a Stripe webhook event
+    Record a Stripe webhook event for the background worker and return, so Stripe gets a quick ack
     """
+    # Other event types are acked without touching the database
+    if event_data.get("type") not in HANDLED_WEBHOOK_EVENTS:
+        return True
+    
     try:
-        event_type = event_data.get("type")
+        # Stripe delivers at least once; a redelivered event id inserts nothing and is acked as is
+        result = await db.execute(
+            dialect_insert(db, WebhookEvent)
+            .values(event_id=event_data["id"], type=event_data.get("type"), payload=event_data)
+            .on_conflict_do_nothing(index_elements=[WebhookEvent.event_id])
+        )
+        await db.commit()
+    except Exception:
+        logger.exception("Error recording Stripe webhook")
+        await db.rollback()
+        return False
+    
+    if result.rowcount:
+        _webhook_events_pending.set()
+    return True
+
+async def _load_subscriptions_by_customer(db: AsyncSession, events: List[Dict[str, Any]]) -> Dict[str, Subscription]:
+    """
+    Load, and lock, the subscriptions that subscription-created events refer to in one query, keyed by customer id
+    """
+    customer_ids = {
+        event_data.get("data", {}).get("object", {}).get("customer")
+        for event_data in events
+        if event_data.get("type") == "customer.subscription.created"
+    }
+    customer_ids.discard(None)
+    if not customer_ids:
+        return {}
+    
+    result = await db.execute(
+        select(Subscription).where(Subscription.stripe_customer_id.in_(customer_ids)).with_for_update()
+    )
+    return {s.stripe_customer_id: s for s in result.scalars()}
+
+async def _apply_webhook_event(db: AsyncSession, event_data: Dict[str, Any],
+                               subscriptions_by_customer: Dict[str, Subscription]) -> None:
+    """
+    Apply a recorded Stripe webhook event to the database, leaving the commit to the caller;
+    subscription-created events find their subscription in subscriptions_by_customer
+    """
+    event_type = event_data.get("type")
+    
+    # Every handled event changes the subscription
+    _subscription_details_cache.pop(event_data.get("data", {}).get("object", {}).get("id"))
+    
+    if event_type == "customer.subscription.created":
+        # New subscription created
+        subscription = event_data.get("data", {}).get("object", {})
+        customer_id = subscription.get("customer")
+        subscription_id = subscription.get("id")
         
-        if event_type == "customer.subscription.created":
-            # New subscription created
-            subscription = event_data.get("data", {}).get("object", {})
-            customer_id = subscription.get("customer")
-            subscription_id = subscription.get("id")
-            
-            # Find user by customer ID
-            db_subscription = db.query(Subscription).filter(
-                Subscription.stripe_customer_id == customer_id
-            ).first()
-            
-            if db_subscription:
-                # Update subscription details
-                db_subscription.stripe_subscription_id = subscription_id
-                db_subscription.is_active = subscription.get("status") in ["active", "trialing"]
-                db_subscription.started_at = datetime.fromtimestamp(subscription.get("start_date"))
-                db_subscription.ended_at = None
-                
-                # Determine tier from price ID
-                items = subscription.get("items", {}).get("data", [])
-                if items:
-                    price_id = items[0].get("price", {}).get("id")
-                    # Map price ID to tier
-                    for tier, tier_data in settings.SUBSCRIPTION_TIERS.items():
-                        if tier_data.get("price_id") == price_id:
-                            db_subscription.tier = tier
-                            break
-                
-                db.commit()
-                return True
+        # Find user by customer ID
+        db_subscription = subscriptions_by_customer.get(customer_id)
         
-        elif event_type == "customer.subscription.updated":
-            # Subscription updated
-            subscription = event_data.get("data", {}).get("object", {})
-            subscription_id = subscription.get("id")
-            
-            # Find subscription by ID
-            db_subscription = db.query(Subscription).filter(
-                Subscription.stripe_subscription_id == subscription_id
-            ).first()
+        if db_subscription:
+            # Update subscription details
+            db_subscription.stripe_subscription_id = subscription_id
+            db_subscription.is_active = subscription.get("status") in ["active", "trialing"]
+            db_subscription.started_at = _from_timestamp(subscription.get("start_date"))
+            db_subscription.ended_at = None
             
-            if db_subscription:
-                # Update subscription details
-                db_subscription.is_active = subscription.get("status") in ["active", "trialing"]
-                
-                # Check if canceled
-                if subscription.get("cancel_at_period_end"):
-                    db_subscription.auto_renew = False
-                    db_subscription.ended_at = datetime.fromtimestamp(subscription.get("current_period_end"))
-                else:
-                    db_subscription.auto_renew = True
-                    db_subscription.ended_at = None
-                
-                db.commit()
-                return True
+            # Determine tier from price ID
+            items = subscription.get("items", {}).get("data", [])
+            if items:
+                price_id = items[0].get("price", {}).get("id")
+                # Map price ID to tier
+                db_subscription.tier = settings.SUBSCRIPTION_PRICE_TIERS.get(price_id, db_subscription.tier)
+    
+    elif event_type == "customer.subscription.updated":
+        # Subscription updated
+        subscription = event_data.get("data", {}).get("object", {})
+        subscription_id = subscription.get("id")
         
-        elif event_type == "customer.subscription.deleted":
-            # Subscription canceled
-            subscription = event_data.get("data", {}).get("object", {})
-            subscription_id = subscription.get("id")
-            
-            # Find subscription by ID
-            db_subscription = db.query(Subscription).filter(
-                Subscription.stripe_subscription_id == subscription_id
-            ).first()
-            
-            if db_subscription:
-                # Mark subscription as inactive and set end date
-                db_subscription.is_active = False
-                db_subscription.auto_renew = False
-                db_subscription.ended_at = datetime.fromtimestamp(subscription.get("canceled_at") or subscription.get("current_period_end"))
-                
-                # Create new basic subscription
-                user_id = db_subscription.user_id
-                new_subscription = Subscription(
-                    user_id=user_id,
-                    tier=SubscriptionTier.BASIC.value,
-                    is_active=True,
-                    auto_renew=False
-                )
-                db.add(new_subscription)
-                
-                db.commit()
-                return True
+        # Everything comes from the payload, so the subscription is updated without reading it first
+        canceled = bool(subscription.get("cancel_at_period_end"))
+        await db.execute(
+            update(Subscription)
+            .where(Subscription.stripe_subscription_id == subscription_id)
+            .values(
+                is_active=subscription.get("status") in ["active", "trialing"],
+                auto_renew=not canceled,
+                ended_at=_from_timestamp(subscription.get("current_period_end")) if canceled else None
+            )
+        )
+    
+    elif event_type == "customer.subscription.deleted":
+        # Subscription canceled
+        subscription = event_data.get("data", {}).get("object", {})
+        subscription_id = subscription.get("id")
         
-        # Other events not handled
-        return True
-    except Exception as e:
-        logger.error(f"Error processing Stripe webhook: {str(e)}")
-        db.rollback()
-        return False
+        paid_subscription = Subscription.stripe_subscription_id == subscription_id
+        
+        # Create new basic subscription for the subscription's user, unless they already have an
+        # active one (e.g. from a replayed deletion)
+        active_basic = aliased(Subscription)
+        basic_subscription = select(
+            Subscription.user_id,
+            literal(SubscriptionTier.BASIC.value),
+            literal(True),
+            literal(False)
+        ).where(
+            paid_subscription,
+            ~exists().where(
+                active_basic.user_id == Subscription.user_id,
+                active_basic.tier == SubscriptionTier.BASIC.value,
+                active_basic.is_active == True
+            )
+        )
+        await db.execute(
+            insert(Subscription).from_select(["user_id", "tier", "is_active", "auto_renew"], basic_subscription)
+        )
+        
+        # Mark subscription as inactive and set end date
+        await db.execute(
+            update(Subscription)
+            .where(paid_subscription)
+            .values(
+                is_active=False,
+                auto_renew=False,
+                ended_at=_from_timestamp(subscription.get("canceled_at") or subscription.get("current_period_end"))
+            )
+        )
+
+# Set when new events are recorded, to wake the webhook worker
+_webhook_events_pending = asyncio.Event()
+
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_POLL_INTERVAL = 30.0  # seconds; picks up events left over from failures or restarts
+
+async def _apply_webhook_events_one_by_one(db: AsyncSession, events: List[Any]) -> None:
+    """
+    Apply webhook events each in their own transaction, so a failing event only fails itself
+    """
+    for webhook_event_id, payload in events:
+        # Claim the event, skipping it if another worker already holds or has processed it
+        # (row locks apply on PostgreSQL; SQLite serializes writers anyway)
+        claimed = await db.scalar(
+            select(WebhookEvent.id)
+            .where(WebhookEvent.id == webhook_event_id, WebhookEvent.processed_at.is_(None))
+            .with_for_update(skip_locked=True)
+        )
+        if claimed is None:
+            await db.rollback()
+            continue
+        
+        try:
+            # Load and lock the event's subscription within its own transaction
+            subscriptions_by_customer = await _load_subscriptions_by_customer(db, [payload])
+            await _apply_webhook_event(db, payload, subscriptions_by_customer)
+            # Flush the ORM changes here, so their errors count against this event
+            await db.flush()
+            processed_at = datetime.utcnow()
+        except Exception:
+            logger.exception("Error processing Stripe webhook %s", payload.get("id"))
+            await db.rollback()
+            processed_at = None
+        await db.execute(
+            update(WebhookEvent)
+            .where(WebhookEvent.id == webhook_event_id)
+            .values(attempts=WebhookEvent.attempts + 1, processed_at=processed_at)
+        )
+        await db.commit()
+
+async def drain_webhook_events(session_factory: Callable[[], AsyncSession]) -> int:
+    """
+    Apply the next batch of unprocessed webhook events in arrival order, returning how many were attempted
+    """
+    async with session_factory() as db:
+        # Claim the batch; rows another worker holds are skipped (row locks apply on PostgreSQL)
+        result = await db.execute(
+            select(WebhookEvent.id, WebhookEvent.payload)
+            .where(WebhookEvent.processed_at.is_(None), WebhookEvent.attempts < WEBHOOK_MAX_ATTEMPTS)
+            .order_by(WebhookEvent.id)
+            .limit(WEBHOOK_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        events = result.all()
+        if not events:
+            return 0
+        
+        # The whole batch is applied and marked processed in one transaction, with one commit
+        try:
+            subscriptions_by_customer = await _load_subscriptions_by_customer(db, [payload for _, payload in events])
+            for _, payload in events:
+                await _apply_webhook_event(db, payload, subscriptions_by_customer)
+                await db.flush()
+            await db.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id.in_([webhook_event_id for webhook_event_id, _ in events]))
+                .values(attempts=WebhookEvent.attempts + 1, processed_at=datetime.utcnow())
+            )
+            await db.commit()
+        except Exception as e:
+            # Start over event by event, so only the failing events are held back
+            logger.warning("Stripe webhook batch failed, retrying events individually: %s", e)
+            await db.rollback()
+            await _apply_webhook_events_one_by_one(db, events)
+        return len(events)
+
+async def run_webhook_worker(session_factory: Callable[[], AsyncSession]) -> None:
+    """
+    Drain recorded webhook events as they arrive, and periodically; runs until cancelled
+    """
+    while True:
+        try:
+            await asyncio.wait_for(_webhook_events_pending.wait(), WEBHOOK_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _webhook_events_pending.clear()
+        try:
+            while await drain_webhook_events(session_factory) == WEBHOOK_BATCH_SIZE:
+                pass
+        except Exception:
+            logger.exception("Error draining Stripe webhooks")
+
+def start_webhook_workers(session_factory: Callable[[], AsyncSession]) -> List[asyncio.Task]:
+    """
+    Start settings.WEBHOOK_WORKERS webhook workers on the running loop
+    """
+    return [
+        asyncio.create_task(run_webhook_worker(session_factory))
+        for _ in range(settings.WEBHOOK_WORKERS)
+    ]
 
 async def get_stripe_publishable_key() -> str:
     """
@@ -256,19 +430,24 @@ async def get_stripe_publishable_key() -> str:
     """
     return settings.STRIPE_PUBLISHABLE_KEY
 
-async def get_subscription_plans() -> List[Dict[str, Any]]:
-    """
-    Get subscription plan details from settings
-    """
-    plans = []
-    for tier_id, tier_data in settings.SUBSCRIPTION_TIERS.items():
-        plans.append({
+# Plans are fixed by settings, so they're built and sorted once at import
+_SUBSCRIPTION_PLANS = sorted(
+    (
+        {
             "id": tier_id,
             "name": tier_data["name"],
             "price": tier_data["monthly_price"],
             "features": tier_data["features"],
             "agents": tier_data["agents"],
             "price_id": tier_data["price_id"]
-        })
-    
-    return sorted(plans, key=lambda x: x["price"]) 
\ No newline at end of file
+        }
+        for tier_id, tier_data in settings.SUBSCRIPTION_TIERS.items()
+    ),
+    key=lambda x: x["price"]
+)
+
+async def get_subscription_plans() -> List[Dict[str, Any]]:
+    """
+    Get subscription plan details from settings
+    """
+    return _SUBSCRIPTION_PLANS 
\ No newline at end of file
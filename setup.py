@@ -9,7 +9,7 @@ setup(
         "uvicorn",
         "sqlalchemy",
         "pydantic",
-        "python-jose[cryptography]",
+        "PyJWT[crypto]",
         "passlib[bcrypt]",
         "python-multipart",
     ],
@@ -0,0 +1,16 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.models import Base
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Async sessions on a fresh SQLite database, configured like app.database.AsyncSessionLocal"""
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    Base.metadata.create_all(bind=create_engine(url))
+    # NullPool, so no connection outlives the event loop of the test that opened it
+    engine = create_async_engine(url.replace("sqlite://", "sqlite+aiosqlite://"), poolclass=NullPool)
+    return sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+# app.api.portfolio re-exports its request models from the agent package
+pytest.importorskip("portfolio_agent")
+
+from app.api.portfolio import list_analyses
+from app.models import AnalysisResult
+
+async def _add_analyses(session_factory, created_ats):
+    async with session_factory() as db:
+        analyses = [
+            AnalysisResult(user_id=1, agent_id="portfolio_agent", created_at=created_at,
+                           result_type="portfolio_analysis", result_data={"n": i})
+            for i, created_at in enumerate(created_ats)
+        ]
+        # Another user's analysis, which is never listed
+        db.add(AnalysisResult(user_id=2, agent_id="portfolio_agent", created_at=datetime(2026, 1, 9),
+                              result_type="portfolio_analysis", result_data={}))
+        db.add_all(analyses)
+        await db.commit()
+        return [analysis.id for analysis in analyses]
+
+async def _list_pages(session_factory, limit):
+    pages = []
+    cursor = cursor_id = None
+    while True:
+        async with session_factory() as db:
+            response = await list_analyses(
+                user_data={"user": SimpleNamespace(id=1)}, db=db, limit=limit,
+                cursor=cursor, cursor_id=cursor_id, agent_id=None, result_type=None
+            )
+        page = orjson.loads(response.body)
+        pages.append(page)
+        if page["next_cursor"] is None:
+            return pages
+        cursor, cursor_id = datetime.fromisoformat(page["next_cursor"]), page["next_cursor_id"]
+
+def test_list_analyses_pages_through_shared_timestamps(session_factory):
+    async def run():
+        # The middle three share a timestamp, which straddles the page boundaries
+        ids = await _add_analyses(session_factory, [
+            datetime(2026, 1, 1), datetime(2026, 1, 2), datetime(2026, 1, 2), datetime(2026, 1, 2), datetime(2026, 1, 3)
+        ])
+        
+        pages = await _list_pages(session_factory, limit=2)
+        
+        assert [[item["id"] for item in page["items"]] for page in pages] == [
+            [ids[4], ids[3]], [ids[2], ids[1]], [ids[0]]
+        ]
+        assert pages[0]["next_cursor_id"] == ids[3]
+        assert pages[-1]["next_cursor_id"] is None
+    
+    asyncio.run(run())
+
+def test_list_analyses_ends_on_an_empty_page(session_factory):
+    async def run():
+        ids = await _add_analyses(session_factory, [datetime(2026, 1, 1), datetime(2026, 1, 2)])
+        
+        pages = await _list_pages(session_factory, limit=2)
+        
+        # A full last page still gets a cursor; the page after it is empty and has none
+        assert [[item["id"] for item in page["items"]] for page in pages] == [[ids[1], ids[0]], []]
+        assert (pages[-1]["next_cursor"], pages[-1]["next_cursor_id"]) == (None, None)
+    
+    asyncio.run(run())
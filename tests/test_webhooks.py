@@ -0,0 +1,116 @@
+import asyncio
+
+from sqlalchemy import select
+
+from app.models import User, Subscription, SubscriptionTier, WebhookEvent
+from app.stripe import drain_webhook_events, process_stripe_webhook
+
+def _event(event_id, event_type, **subscription):
+    return {"id": event_id, "type": event_type, "data": {"object": subscription}}
+
+async def _add_user(db, email, **subscription):
+    user = User(email=email)
+    db.add(user)
+    await db.flush()
+    db.add(Subscription(user_id=user.id, **subscription))
+    await db.commit()
+    return user.id
+
+async def _record(session_factory, *events):
+    async with session_factory() as db:
+        for event_data in events:
+            assert await process_stripe_webhook(event_data, db)
+
+async def _subscriptions(session_factory, user_id):
+    async with session_factory() as db:
+        result = await db.execute(
+            select(Subscription).where(Subscription.user_id == user_id).order_by(Subscription.id)
+        )
+        return result.scalars().all()
+
+async def _webhook_events(session_factory):
+    async with session_factory() as db:
+        result = await db.execute(select(WebhookEvent).order_by(WebhookEvent.id))
+        return result.scalars().all()
+
+def test_drain_applies_batch(session_factory):
+    async def run():
+        async with session_factory() as db:
+            created_user = await _add_user(db, "created@example.com", stripe_customer_id="cus_1", tier="basic")
+            deleted_user = await _add_user(
+                db, "deleted@example.com", stripe_customer_id="cus_2", stripe_subscription_id="sub_2",
+                tier="professional", is_active=True
+            )
+        await _record(
+            session_factory,
+            _event("evt_1", "customer.subscription.created", id="sub_1", customer="cus_1", status="active"),
+            _event("evt_2", "customer.subscription.deleted", id="sub_2", customer="cus_2", canceled_at=1700000000),
+            _event("evt_3", "invoice.paid", id="in_1")
+        )
+        
+        assert await drain_webhook_events(session_factory) == 2
+        assert await drain_webhook_events(session_factory) == 0
+        
+        created = await _subscriptions(session_factory, created_user)
+        assert [(s.stripe_subscription_id, s.is_active) for s in created] == [("sub_1", True)]
+        deleted = await _subscriptions(session_factory, deleted_user)
+        assert [(s.tier, s.is_active) for s in deleted] == [
+            ("professional", False), (SubscriptionTier.BASIC.value, True)
+        ]
+        assert deleted[0].ended_at is not None
+        
+        events = await _webhook_events(session_factory)
+        assert [(e.event_id, e.attempts) for e in events] == [("evt_1", 1), ("evt_2", 1)]
+        assert all(e.processed_at is not None for e in events)
+    
+    asyncio.run(run())
+
+def test_duplicate_event_id_is_applied_once(session_factory):
+    async def run():
+        async with session_factory() as db:
+            user_id = await _add_user(
+                db, "deleted@example.com", stripe_customer_id="cus_1", stripe_subscription_id="sub_1",
+                tier="professional", is_active=True
+            )
+        deleted = _event("evt_1", "customer.subscription.deleted", id="sub_1", customer="cus_1")
+        await _record(session_factory, deleted, deleted)
+        
+        assert await drain_webhook_events(session_factory) == 1
+        # A redelivery after the event was applied is recorded as nothing too
+        await _record(session_factory, deleted)
+        assert await drain_webhook_events(session_factory) == 0
+        
+        subscriptions = await _subscriptions(session_factory, user_id)
+        assert [s.tier for s in subscriptions if s.is_active] == [SubscriptionTier.BASIC.value]
+        assert len(await _webhook_events(session_factory)) == 1
+    
+    asyncio.run(run())
+
+def test_failing_event_falls_back_to_one_by_one(session_factory):
+    async def run():
+        async with session_factory() as db:
+            good_user = await _add_user(db, "good@example.com", stripe_customer_id="cus_1")
+            await _add_user(db, "bad@example.com", stripe_customer_id="cus_2")
+            await _add_user(db, "taken@example.com", stripe_customer_id="cus_3", stripe_subscription_id="sub_3")
+        await _record(
+            session_factory,
+            # sub_3 already belongs to another subscription, so this one violates the unique constraint
+            _event("evt_1", "customer.subscription.created", id="sub_3", customer="cus_2", status="active"),
+            _event("evt_2", "customer.subscription.created", id="sub_1", customer="cus_1", status="active")
+        )
+        
+        assert await drain_webhook_events(session_factory) == 2
+        
+        subscriptions = await _subscriptions(session_factory, good_user)
+        assert [(s.stripe_subscription_id, s.is_active) for s in subscriptions] == [("sub_1", True)]
+        failed, applied = await _webhook_events(session_factory)
+        assert (failed.attempts, failed.processed_at) == (1, None)
+        assert applied.attempts == 1 and applied.processed_at is not None
+        
+        # The failed event is retried on the next drain, and the applied one isn't
+        assert await drain_webhook_events(session_factory) == 1
+        failed, applied = await _webhook_events(session_factory)
+        assert (failed.attempts, failed.processed_at) == (2, None)
+        assert applied.attempts == 1
+    
+    asyncio.run(run())